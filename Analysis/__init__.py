@@ -0,0 +1,5 @@
+##################################################################
+#The Smart Compost analysis code as a package, so tools can
+#"import Analysis.getReadings" without starting the daemon or the radio.
+#The daemon itself runs with: python getReadings.py
+##################################################################
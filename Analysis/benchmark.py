@@ -0,0 +1,142 @@
+##################################################################
+#benchmark.py is part of the Smart Compost system
+#Runs full read cycles (scan, connect, read, persist, analyze, writeToUI)
+#against simulated piles (fakeBLE.py) and reports cycle latency,
+#readings/sec and where the time goes. Nothing touches the radio or the
+#real database; everything is written to a temporary folder
+#
+#Usage: python benchmark.py [piles ...] [--cycles N] [--workers N] [--latency secs] [--failures rate] [--verbose]
+#e.g.   python benchmark.py 1 10 100 1000 --latency 0.005
+#######
+#Questions: @darianbjohnson (Twitter) or darianbjohnson.com
+##################################################################
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+os.environ["COMPOST_BLE"] = "fake"
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+workFolder = tempfile.mkdtemp(prefix="compost-benchmark-")
+os.chdir(workFolder) #getReadings opens smart_compost.db in the working folder when imported
+
+import fakeBLE
+import getReadings
+
+#*************************************************************
+#Stage timers: wrap the functions each stage calls
+#*************************************************************
+stages = ["scan", "connect", "read", "persist", "analyze", "writeToUI"]
+stageFunctions = {"scan":(getReadings, "getMACs"), "connect":(fakeBLE, "Peripheral"), "read":(getReadings, "readCompostValues"),
+    "persist":(getReadings, "persistSensorData"), "analyze":(getReadings, "analyzeData"), "writeToUI":(getReadings, "writeToUI")}
+timings = {} #stage -> [secs, ...]
+timingsLock = threading.Lock()
+
+def timed(stage, function):
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            with timingsLock:
+                timings.setdefault(stage, []).append(time.time() - start)
+    return wrapper
+
+for stage in stages:
+    module, name = stageFunctions[stage]
+    setattr(module, name, timed(stage, getattr(module, name)))
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+#*************************************************************
+#Function to run one benchmark: a fresh database and fleet of piles
+#*************************************************************
+def runBenchmark(piles, cycles, workers):
+    folder = os.path.join(workFolder, "piles%d" % piles)
+    os.mkdir(folder)
+    getReadings.store = getReadings.CompostStore(os.path.join(folder, "smart_compost.db"))
+    getReadings.json_output = os.path.join(folder, "currentReadings.json")
+    getReadings.fleet_json_output = os.path.join(folder, "fleetReadings.json")
+    getReadings.uiPublisher = getReadings.UIPublisher()
+    getReadings.discoveryCache = getReadings.DiscoveryCache()
+    getReadings.discoveryScanner = getReadings.BackgroundScanner(getReadings.discoveryCache)
+    getReadings.characteristicCache = getReadings.CharacteristicCache()
+    getReadings.trendEstimators.clear()
+    getReadings.fleetMode = True
+    getReadings.fleetMACs = []
+    getReadings.fleetWorkers = workers
+    getReadings.initDatabase()
+    fakeBLE.configure(piles, 0)
+    timings.clear()
+
+    cycleTimes = []
+    readings = 0
+    for x in range(0, cycles):
+        start = time.time()
+        results = getReadings.pollFleet()
+        cycleTimes.append(time.time() - start)
+        readings += len([r for r in results.values() if isinstance(r, basestring) and r != "timeout"])
+    getReadings.store.close()
+    return cycleTimes, readings
+
+def report(piles, cycleTimes, readings):
+    total = sum(cycleTimes)
+    out = sys.__stdout__
+    out.write("\n%d piles, %d cycles, %d readings\n" % (piles, len(cycleTimes), readings))
+    out.write("  cycle latency: mean %.3fs  p95 %.3fs\n" % (total / len(cycleTimes), percentile(cycleTimes, 0.95)))
+    out.write("  throughput:    %.1f readings/sec\n" % (readings / total if total else 0.0))
+    analyze = sum(timings.get("analyze", [])) - sum(timings.get("writeToUI", [])) #analyzeData calls writeToUI
+    out.write("  %-10s %8s %10s %10s %10s\n" % ("stage", "calls", "total s", "mean ms", "p95 ms"))
+    for stage in stages:
+        values = timings.get(stage, [])
+        spent = analyze if stage == "analyze" else sum(values)
+        mean = spent / len(values) * 1000 if values else 0.0
+        out.write("  %-10s %8d %10.3f %10.2f %10.2f\n" % (stage, len(values), spent, mean, percentile(values, 0.95) * 1000))
+    out.write("  (analyze total and mean leave out writeToUI, p95 includes it)\n")
+
+def main():
+    pileCounts = []
+    cycles = 3
+    workers = getReadings.fleetWorkers
+    verbose = False
+    args = sys.argv[1:]
+    while args:
+        arg = args.pop(0)
+        if arg == "--cycles":
+            cycles = int(args.pop(0))
+        elif arg == "--workers":
+            workers = int(args.pop(0))
+        elif arg == "--latency":
+            fakeBLE.latency = float(args.pop(0))
+        elif arg == "--failures":
+            fakeBLE.failureRate = float(args.pop(0))
+        elif arg == "--verbose":
+            verbose = True
+        else:
+            pileCounts.append(int(arg))
+    if not pileCounts:
+        pileCounts = [1, 10, 100]
+    fakeBLE.scanTime = 0.1
+
+    sys.__stdout__.write("BLE latency %.3fs/operation, failure rate %.2f, %d workers\n" % (fakeBLE.latency, fakeBLE.failureRate, workers))
+    try:
+        for piles in pileCounts:
+            if not verbose:
+                sys.stdout = open(os.devnull, "w") #getReadings prints every reading
+            try:
+                cycleTimes, readings = runBenchmark(piles, cycles, workers)
+            finally:
+                sys.stdout = sys.__stdout__
+            report(piles, cycleTimes, readings)
+    finally:
+        shutil.rmtree(workFolder, True)
+
+if __name__ == "__main__":
+    main()
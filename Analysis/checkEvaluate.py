@@ -0,0 +1,100 @@
+##################################################################
+#checkEvaluate.py is part of the Smart Compost system
+#Checks that the batch evaluator (evaluateReadings) gives exactly what
+#evaluateReading gives, reading by reading, for random readings around
+#every limit - with the default rules and with a rulesFile that overrides
+#limits and reorders the rules. Exits with status 1 on any difference
+#
+#Usage: python checkEvaluate.py [rows] [--seed N]
+#######
+#Questions: @darianbjohnson (Twitter) or darianbjohnson.com
+##################################################################
+
+import os
+import sys
+import json
+import random
+import shutil
+import tempfile
+
+os.environ["COMPOST_BLE"] = "fake"
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+workFolder = tempfile.mkdtemp(prefix="compost-check-")
+os.chdir(workFolder) #getReadings opens smart_compost.db in the working folder when imported
+
+import numpy as np
+import getReadings
+
+outputs = ["tempAlert", "moistAlert", "methaneAlert", "waterLevelAlert", "scrapLevelAlert", "tempMsg", "moistMsg", "msgPriority", "ventAngle", "needWater"]
+
+#a pile whose limits and rules differ from the defaults: moisture first trumps at priority 2, hot piles vent without water
+alternateRules = {"piles":{"check":{"limits":{"tempHigh":150, "moistHigh":70, "methaneMedium":5000},
+    "rules":{"temperature":[
+        {"when":{"ambient":"low", "value":{"atMost":"tempLow"}}, "alert":"danger", "message":10, "priority":1, "vent":0},
+        {"when":{"value":{"atLeast":"tempHigh"}}, "alert":"danger", "message":4, "priority":1, "vent":1},
+        {"when":{"value":{"above":"tempOK"}, "trend":{"atMost":0}}, "alert":"warning", "message":5, "priority":2, "vent":1, "water":1},
+        {"when":{"value":{"above":"tempLow"}}, "alert":"success", "message":7, "priority":3}],
+    "moisture":[
+        {"when":{"value":{"atLeast":"moistHigh"}}, "alert":"danger", "message":0, "priority":2, "vent":1},
+        {"when":{"value":{"below":"moistLow"}, "trend":{"below":0}}, "alert":"warning", "message":3, "priority":2, "water":1, "append":True},
+        {"when":{"value":{"below":"moistLow"}}, "alert":"danger", "message":4, "priority":1, "water":1}]}}}}
+
+def column(rows, points, low, high, missing=0.02): #random values, a share of them exactly on a limit or missing
+    values = np.random.uniform(low, high, rows)
+    onPoint = np.random.random(rows) < 0.2
+    values[onPoint] = np.random.choice(points, onPoint.sum())
+    values[np.random.random(rows) < missing] = np.nan
+    return values
+
+def checkRules(rows, rules):
+    limits = rules.limits
+    tempF = column(rows, [limits[name] for name in ["tempDanger", "tempHigh", "tempOK", "tempLow"]], 20, 200)
+    ambientLow = np.random.random(rows) < 0.3
+    moisture = column(rows, [limits["moistHigh"], limits["moistLow"]], 0, 100)
+    methane = column(rows, [limits["methaneHigh"], limits["methaneMedium"]], 0, 60000)
+    waterLevel = column(rows, [0, 1], 0, 1)
+    tempTrend = column(rows, [-1, 0, 1], -3, 3)
+    moistTrend = column(rows, [-1, 0, 1], -3, 3)
+    days = np.random.randint(0, getReadings.daysWhenReady + 5, rows).astype(float)
+    lastScrapLevel = column(rows, [limits["scrapHigh"], limits["scrapMedium"]], 0, 40)
+
+    batch = getReadings.evaluateReadings(tempF, ambientLow, moisture, methane, waterLevel, tempTrend, moistTrend, days, lastScrapLevel, rules)
+    scalar = lambda x: None if np.isnan(x) else float(x)
+    mismatches = 0
+    for x in range(0, rows):
+        result = getReadings.evaluateReading(scalar(tempF[x]), "low" if ambientLow[x] else "high", scalar(moisture[x]), scalar(methane[x]), scalar(waterLevel[x]),
+            scalar(tempTrend[x]), scalar(moistTrend[x]), scalar(days[x]), scalar(lastScrapLevel[x]), rules)
+        different = [name for name in outputs if result[name] != batch[name][x]]
+        if different:
+            mismatches += 1
+            if mismatches <= 10:
+                print "Row %d differs in %s" % (x, ", ".join(different))
+    return mismatches
+
+def main():
+    args = sys.argv[1:]
+    rows = 200000
+    seed = 0
+    while args:
+        arg = args.pop(0)
+        if arg == "--seed":
+            seed = int(args.pop(0))
+        else:
+            rows = int(arg)
+    random.seed(seed)
+    np.random.seed(seed)
+
+    failed = False
+    try:
+        with open(getReadings.rulesFile, "w") as f:
+            json.dump(alternateRules, f)
+        for name, device in [("default rules", getReadings.defaultDevice), ("rulesFile overrides", "check")]:
+            mismatches = checkRules(rows, getReadings.rulesFor(device))
+            print "%s: %d readings, %d differ" % (name, rows, mismatches)
+            failed = failed or mismatches > 0
+    finally:
+        shutil.rmtree(workFolder, True)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+##################################################################
+#fakeBLE.py is part of the Smart Compost system
+#An in-process stand-in for the parts of bluepy.btle that getReadings.py
+#uses. It simulates Compost piles and KitchenBins with the same services,
+#characteristics and notify handle as the Arduino sketches, with
+#configurable latency and failure rates, so the analysis code can run and
+#be benchmarked without Bluetooth hardware.
+#
+#Run getReadings.py with COMPOST_BLE=fake to use it
+#######
+#Questions: @darianbjohnson (Twitter) or darianbjohnson.com
+##################################################################
+
+import random
+import struct
+import threading
+import time
+
+#*************************************************************
+#Simulation Settings
+#*************************************************************
+latency = 0.01 #secs per GATT operation (connect, discovery, read, write)
+failureRate = 0.0 #chance that a GATT operation raises BTLEException
+scanTime = 0.5 #secs a scan takes at most, whatever timeout is asked for
+notifyInterval = 60.0 #secs between KitchenBin level notifications
+packedReadings = True #piles expose the all readings characteristic
+packedFormat = 1 #format version of the all readings characteristic; 0 = the ASCII string of older firmware
+historySize = 96 #readings a pile with the packed format buffers while nobody is connected (0 = no history)
+historyInterval = 900.0 #secs between buffered readings
+historyLossRate = 0.0 #chance that a buffered reading's notification never arrives
+
+compostServiceUUID = "0411dc90-895b-4639-b627-c663f6726c3c"
+kitchenBinServiceUUID = "9a4587b1-4d85-4c75-b88b-faa619295a18"
+kitchenBinLevelUUID = "9a4587b2-4d85-4c75-b88b-faa619295a18"
+historyUUID = "0411dc9a-895b-4639-b627-c663f6726c3c"
+historyControlUUID = "0411dc9b-895b-4639-b627-c663f6726c3c"
+
+class BTLEException(Exception):
+    pass
+
+class DefaultDelegate(object):
+    def __init__(self):
+        pass
+
+    def handleNotification(self, cHandle, data):
+        pass
+
+    def handleDiscovery(self, scanEntry, isNewDev, isNewData):
+        pass
+
+class UUID(object):
+    def __init__(self, val):
+        self.val = str(val).lower()
+
+    def __str__(self):
+        return self.val
+
+    def __eq__(self, other):
+        return str(self) == str(other).lower()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.val)
+
+def simulateOperation():
+    if latency:
+        time.sleep(latency)
+    if failureRate and random.random() < failureRate:
+        raise BTLEException("Simulated failure")
+
+#*************************************************************
+#Simulated devices
+#*************************************************************
+class SimulatedCharacteristic(object):
+    def __init__(self, uuid, handle, value=""):
+        self.uuid = UUID(uuid)
+        self.valHandle = handle
+        self.value = value
+        self.written = []
+
+class SimulatedCompost(object):
+    name = "Compost"
+
+    def __init__(self, MAC, rssi=-60):
+        self.MAC = MAC
+        self.rssi = rssi
+        self.tempF = random.uniform(90, 170)
+        self.ambientTempF = random.uniform(35, 90)
+        self.sequence = 0
+        self.boot = time.time()
+        self.bootId = random.randint(1, 0x7FFFFFFF)
+        self.history = [] #packed readings not acknowledged yet
+        self.historySequence = 0
+        self.historyHandle = None
+        self.lastBuffered = self.boot
+        self.moisture = random.choice([30, 50, 65])
+        self.methane = random.randint(10, 20000)
+        self.waterLevel = 1
+        self.serviceUUID = compostServiceUUID
+        self.characteristics = []
+        for x in range(1, 10 if packedReadings else 9):
+            self.characteristics.append(SimulatedCharacteristic("0411dc9%d-895b-4639-b627-c663f6726c3c" % x, 0x0b + 2 * x))
+        if packedReadings and packedFormat and historySize:
+            self.historyHandle = 0x1f
+            self.characteristics.append(SimulatedCharacteristic(historyUUID, self.historyHandle))
+            self.characteristics.append(SimulatedCharacteristic(historyControlUUID, 0x21))
+        self.refresh()
+
+    def refresh(self): #new sensor values, like readSensors() on the Arduino
+        self.tempF = max(0, self.tempF + random.uniform(-3, 3))
+        self.moisture = random.choice([30, 50, 65])
+        self.sequence += 1
+        if packedFormat:
+            allReadings = self.pack(self.sequence, time.time())
+        else:
+            allReadings = "%d,%d,%d,%d,%d" % (self.tempF, self.ambientTempF, self.moisture, self.methane, self.waterLevel)
+        values = ["%20d" % int(time.time()), "%5d" % self.tempF, "%5d" % self.ambientTempF, "%5d" % self.moisture,
+            "%5d" % self.methane, "%4d" % self.waterLevel, "\x00", "\x00", allReadings]
+        for ch, value in zip(self.characteristics, values):
+            ch.value = value
+
+    def sensorTime(self, t): #the clock was never set, it counts from power on
+        return int(t - self.boot)
+
+    def pack(self, sequence, t):
+        return struct.pack("<BIIhhBIB", packedFormat, sequence, self.sensorTime(t), int(self.tempF * 100),
+            int(self.ambientTempF * 100), self.moisture, self.methane, self.waterLevel)
+
+    def bufferReadings(self): #the readings taken every historyInterval secs since the last connection
+        if self.historyHandle is None:
+            return
+        while self.lastBuffered + historyInterval <= time.time():
+            self.lastBuffered += historyInterval
+            self.historySequence += 1
+            self.history.append(self.pack(self.historySequence, self.lastBuffered))
+        del self.history[:-historySize]
+
+    def restart(self): #power cycle: the buffer is lost and the sequence starts again
+        self.boot = self.lastBuffered = time.time()
+        self.bootId = random.randint(1, 0x7FFFFFFF)
+        self.history = []
+        self.historySequence = 0
+
+    def historyControl(self, val): #returns the notifications to send
+        ack = struct.unpack("<I", val)[0]
+        if ack: #stored by the host, drop them
+            self.history = [reading for reading in self.history if struct.unpack_from("<I", reading, 1)[0] > ack]
+            return []
+        sent = [reading for reading in self.history if random.random() >= historyLossRate]
+        first = self.historySequence - len(self.history) + 1
+        return sent + [struct.pack("<BIIII", 0, first, self.historySequence, self.sensorTime(time.time()), self.bootId)]
+
+class SimulatedKitchenBin(object):
+    name = "KitchenBin"
+
+    def __init__(self, MAC, rssi=-60):
+        self.MAC = MAC
+        self.rssi = rssi
+        self.level = 0
+        self.serviceUUID = kitchenBinServiceUUID
+        self.characteristics = [SimulatedCharacteristic(kitchenBinLevelUUID, 0x0b, "%5d" % self.level)]
+
+    def nextLevel(self): #the bin fills up and is emptied now and then
+        if self.level > 15 and random.random() < 0.3:
+            self.level = 0
+        else:
+            self.level += random.randint(0, 3)
+        self.characteristics[0].value = "%5d" % self.level
+        return self.characteristics[0].value
+
+class SimulatedWorld(object):
+    def __init__(self):
+        self.devices = {} #MAC -> simulated device
+        self.lock = threading.Lock()
+
+    def add(self, device):
+        with self.lock:
+            self.devices[device.MAC] = device
+        return device
+
+    def clear(self):
+        with self.lock:
+            self.devices.clear()
+
+    def get(self, MAC):
+        with self.lock:
+            if MAC not in self.devices:
+                raise BTLEException("Failed to connect to peripheral " + MAC)
+            return self.devices[MAC]
+
+    def all(self):
+        with self.lock:
+            return self.devices.values()
+
+world = SimulatedWorld()
+
+def simulatedMAC(kind, x):
+    return "fa:ce:%02x:%02x:%02x:%02x" % (kind, (x >> 16) & 0xff, (x >> 8) & 0xff, x & 0xff)
+
+def configure(piles=1, kitchenBins=1): #replaces the simulated devices; returns the pile MACs
+    world.clear()
+    MACs = []
+    for x in range(0, piles):
+        MACs.append(world.add(SimulatedCompost(simulatedMAC(1, x), random.randint(-90, -40))).MAC)
+    for x in range(0, kitchenBins):
+        world.add(SimulatedKitchenBin(simulatedMAC(2, x), random.randint(-90, -40)))
+    return MACs
+
+configure()
+
+#*************************************************************
+#bluepy.btle API
+#*************************************************************
+class ScanEntry(object):
+    def __init__(self, device):
+        self.addr = device.MAC
+        self.addrType = "public"
+        self.rssi = device.rssi + random.randint(-5, 5)
+        self.name = device.name
+
+    def getScanData(self):
+        return [(9, "Complete Local Name", self.name)]
+
+    def getValueText(self, adtype):
+        if adtype == 9:
+            return self.name
+        return None
+
+class Scanner(object):
+    def __init__(self, iface=0):
+        self.delegate = DefaultDelegate()
+
+    def withDelegate(self, delegate):
+        self.delegate = delegate
+        return self
+
+    def scan(self, timeout=10, passive=False):
+        time.sleep(min(timeout, scanTime))
+        entries = []
+        for device in world.all():
+            entry = ScanEntry(device)
+            self.delegate.handleDiscovery(entry, True, True)
+            entries.append(entry)
+        return entries
+
+class Characteristic(object):
+    def __init__(self, peripheral, simulated):
+        self.peripheral = peripheral
+        self.simulated = simulated
+        self.uuid = simulated.uuid
+        self.valHandle = simulated.valHandle
+
+    def getHandle(self):
+        return self.valHandle
+
+    def supportsRead(self):
+        return True
+
+    def read(self):
+        return self.peripheral.readCharacteristic(self.valHandle)
+
+    def write(self, val, withResponse=False):
+        return self.peripheral.writeCharacteristic(self.valHandle, val, withResponse)
+
+class Service(object):
+    def __init__(self, peripheral, device):
+        self.peripheral = peripheral
+        self.device = device
+        self.uuid = UUID(device.serviceUUID)
+
+    def getCharacteristics(self, forUUID=None):
+        simulateOperation()
+        return [Characteristic(self.peripheral, ch) for ch in self.device.characteristics if forUUID is None or ch.uuid == forUUID]
+
+class Peripheral(object):
+    def __init__(self, deviceAddr=None, addrType="public", iface=None):
+        self.delegate = DefaultDelegate()
+        self.device = None
+        self.notifying = False
+        self.nextNotification = 0
+        self.pending = [] #compost history notifications
+        if deviceAddr is not None:
+            self.connect(deviceAddr)
+
+    def connect(self, addr, addrType="public", iface=None):
+        simulateOperation()
+        self.device = world.get(addr)
+        if isinstance(self.device, SimulatedCompost):
+            self.device.bufferReadings()
+            self.device.refresh()
+
+    def getState(self):
+        if self.device is None:
+            return "disc"
+        return "conn"
+
+    def checkConnected(self):
+        if self.device is None:
+            raise BTLEException("Not connected")
+
+    def setDelegate(self, delegate):
+        self.delegate = delegate
+
+    def withDelegate(self, delegate):
+        self.delegate = delegate
+        return self
+
+    def getServiceByUUID(self, uuidVal):
+        self.checkConnected()
+        simulateOperation()
+        if UUID(uuidVal) != self.device.serviceUUID:
+            raise BTLEException("Service not found " + str(uuidVal))
+        return Service(self, self.device)
+
+    def getCharacteristics(self, startHnd=1, endHnd=0xFFFF, uuid=None):
+        self.checkConnected()
+        return Service(self, self.device).getCharacteristics(uuid)
+
+    def findCharacteristic(self, handle):
+        for ch in self.device.characteristics:
+            if ch.valHandle == handle:
+                return ch
+        raise BTLEException("Invalid handle " + str(handle))
+
+    def readCharacteristic(self, handle):
+        self.checkConnected()
+        simulateOperation()
+        return self.findCharacteristic(handle).value
+
+    def writeCharacteristic(self, handle, val, withResponse=False):
+        self.checkConnected()
+        simulateOperation()
+        if isinstance(self.device, SimulatedKitchenBin) and handle == self.device.characteristics[0].valHandle + 1:
+            self.notifying = val == "\x01\x00" #client characteristic configuration
+            self.nextNotification = time.time()
+            return
+        if isinstance(self.device, SimulatedCompost) and self.device.historyHandle is not None:
+            if handle == self.device.historyHandle + 1: #client characteristic configuration of the history
+                self.notifying = val == "\x01\x00"
+                return
+            if str(self.findCharacteristic(handle).uuid) == historyControlUUID:
+                self.pending = self.device.historyControl(val) if self.notifying else []
+        self.findCharacteristic(handle).written.append(val)
+
+    def waitForNotifications(self, timeout):
+        self.checkConnected()
+        if self.pending:
+            simulateOperation()
+            self.delegate.handleNotification(self.device.historyHandle, self.pending.pop(0))
+            return True
+        if self.notifying and isinstance(self.device, SimulatedKitchenBin):
+            wait = self.nextNotification - time.time()
+            if wait <= timeout:
+                time.sleep(max(0, wait))
+                self.nextNotification = time.time() + notifyInterval
+                self.delegate.handleNotification(self.device.characteristics[0].valHandle, self.device.nextLevel())
+                return True
+        time.sleep(timeout)
+        return False
+
+    def disconnect(self):
+        self.device = None
+        self.notifying = False
+        self.pending = []
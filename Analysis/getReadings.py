@@ -10,22 +10,31 @@
 ##################################################################
 
 
-from bluepy.btle import Scanner, DefaultDelegate, UUID, Peripheral
-import time
-import binascii
+import os
 import struct
 
 from datetime import timedelta, datetime
 import json
 import sqlite3
 import time
-import math
+import contextlib
 import io
-import os
+import sys
+import collections
+import threading
+import Queue
+import heapq
+import itertools
+import hashlib
+import subprocess
+import re
+from email.utils import formatdate
+import uiServer
+import sampleQueue
+import ruleEngine
+from metrics import Metrics
 #from scipy.stats import linregress 
-#for sudo apt-get install python-numpy 
-#for sudo apt-get install python-scipy 
-import numpy as np
+#trends are computed with running sums (TrendEstimator), numpy is not needed
 
 #*************************************************************
 #Custom Dictionary for creating JSON from Sqlite
@@ -36,20 +45,217 @@ def dict_factory(cursor, row):
         d[col[0]] = row[idx]
     return d
 
+#*************************************************************
+#Metrics: timers for each stage of a cycle (BLE scan, connect, each
+#characteristic read, each SQLite statement, analysis, JSON write),
+#counters for misses, retries and swallowed exceptions, and gauges for the
+#database. Served at /metrics in the Prometheus text format
+#*************************************************************
+metrics = Metrics("compost_")
+metrics.describe("stage_seconds", "Time spent in each stage of a cycle")
+metrics.describe("ble_read_seconds", "Time per characteristic read")
+metrics.describe("sqlite_seconds", "Time per SQLite statement")
+metrics.describe("scan_misses_total", "Lookups that found no device with the name")
+metrics.describe("retries_total", "BLE operations retried and tasks rescheduled after a failure or a miss")
+metrics.describe("exceptions_total", "Exceptions caught and logged instead of raised")
+
+statementLabels = {} #SQL -> (verb, table)
+statementSkipWords = set(["if", "not", "exists", "or", "replace", "ignore"])
+
+def statementLabel(sql): #("insert", "readings") for "INSERT into readings ..."
+    label = statementLabels.get(sql)
+    if label is None:
+        words = [w.lower() for w in re.findall(r"[A-Za-z_]+", sql)]
+        table = ""
+        for x in range(0, len(words) - 1):
+            if words[x] in ("from", "into", "update", "table", "index"):
+                names = [w for w in words[x + 1:x + 5] if w not in statementSkipWords]
+                if names and names[0] not in ("select", "on"): #FROM (SELECT ...) names its table further on
+                    table = names[0]
+                    break
+        label = statementLabels[sql] = (words[0] if words else "", table)
+    return label
+
+class TimedConnection(object): #the connection handed out by store.transaction(), times each statement
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, params=()):
+        verb, table = statementLabel(sql)
+        with metrics.timer("sqlite_seconds", statement=verb, table=table):
+            return self.conn.execute(sql, params)
+
+    def executemany(self, sql, rows):
+        verb, table = statementLabel(sql)
+        with metrics.timer("sqlite_seconds", statement=verb, table=table):
+            return self.conn.executemany(sql, rows)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+#*************************************************************
+#Storage layer: one long-lived SQLite connection shared by every
+#function. The database runs in WAL mode and the statements below are
+#reused from the connection's statement cache. Writers wrap their work in
+#store.transaction(); nested calls join the outer transaction, so a whole
+#analysis cycle (store.cycle()) commits - and fsyncs - only once
+#*************************************************************
+class CompostStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.depth = 0
+        self.lock = threading.RLock() #fleet workers share the connection, one transaction at a time
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, isolation_level=None, cached_statements=64, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL") #WAL is still durable at checkpoints, commits skip the fsync
+        return self.conn
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return TimedConnection(self.connect()).execute(sql, params)
+
+    def query(self, sql, params=()):
+        verb, table = statementLabel(sql)
+        with self.lock, metrics.timer("sqlite_seconds", statement=verb, table=table):
+            return self.connect().execute(sql, params).fetchall()
+
+    def queryDicts(self, sql, params=()):
+        verb, table = statementLabel(sql)
+        with self.lock, metrics.timer("sqlite_seconds", statement=verb, table=table):
+            c = self.connect().cursor()
+            c.row_factory = dict_factory
+            c.execute(sql, params)
+            rows = c.fetchall()
+            c.close()
+        return rows
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            conn = self.connect()
+            if self.depth == 0:
+                conn.execute("BEGIN")
+            self.depth += 1
+            try:
+                yield TimedConnection(conn)
+            except:
+                self.depth -= 1
+                if self.depth == 0:
+                    conn.execute("ROLLBACK")
+                raise
+            self.depth -= 1
+            if self.depth == 0:
+                with metrics.timer("sqlite_seconds", statement="commit", table=""):
+                    conn.execute("COMMIT")
+
+    def cycle(self): #one transaction for the whole read/persist/analyze cycle
+        return self.transaction()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+#*************************************************************
+#Cycle clock: the time is taken when a cycle starts, not when the script
+#was loaded, so a reading, its rollup, its trends and its UI row share one
+#timestamp and the next cycle gets a new one
+#*************************************************************
+cycleState = threading.local() #fleet workers each run their own cycle
+
+def cycleEpoch(): #time of the current cycle, or now outside a cycle
+    return getattr(cycleState, "epoch", None) or time.time()
+
+def cycleToday():
+    return datetime.fromtimestamp(cycleEpoch())
+
+@contextlib.contextmanager
+def analysisCycle(epoch=None): #one transaction and one timestamp for the read/persist/analyze cycle (epoch = when a queued sample was read)
+    cycleState.epoch = epoch or time.time()
+    try:
+        with store.cycle():
+            yield
+    finally:
+        cycleState.epoch = None
+
 #*************************************************************
 #BTLE Settings
 #*************************************************************
+bleBackend = os.environ.get("COMPOST_BLE", "bluepy") #bluepy talks to the radio, fake = fakeBLE.py simulates the piles and KitchenBin
+bleTransport = None
+
+def ble(): #bluepy.btle (or fakeBLE), imported on first use so tools can import this file without the radio
+    global bleTransport
+    if bleTransport is None:
+        if bleBackend == "fake":
+            import fakeBLE as transport
+        else:
+            from bluepy import btle as transport
+        bleTransport = transport
+    return bleTransport
+
 deviceNameCompost = "Compost"
 sleepIfFound = 3600  #secs - 1 hr
 sleepIfNotFound = 300 #secs - 5 mins
 
+#Fleet mode - poll every pile instead of a single one
+fleetMode = False
+fleetMACs = [] #fixed list of pile MACs; leave empty to discover every device named deviceNameCompost
+fleetWorkers = 4 #piles read at the same time
+fleetDeviceTimeout = 60 #secs - a pile that takes longer is disconnected and skipped this round
+defaultDevice = "default" #device ID of the pile in single pile mode
+
+#Adaptive polling - each pile's next poll comes from its last analysis (sleepIfFound for a steady pile)
+pollIntervalMin = 300 #secs - piles in danger are read this often
+pollIntervalWarning = 900 #secs - longest wait for a pile with a warning
+pollIntervalMax = 14400 #secs - longest wait for a steady or cured pile
+pollLeadFraction = 0.25 #read again after this part of the time the temp trend needs to reach the next limit
+pollBackoffMax = 3600 #secs - longest wait after misses in a row (starts at sleepIfNotFound)
+radioBudget = 0.05 #part of the time BLE connections may take; piles not in danger wait when it is spent
+radioBudgetWindow = 3600 #secs
+
+#Retries - each read or write is retried on the same connection, reconnecting only if it dropped
+readRetries = 2 #retries after the first attempt
+readRetryDelay = 0.5 #secs before the first retry, doubled for each one after it
+readRetryDelayMax = 4 #secs
+sessionKeepAlive = 0 #secs - stay connected to a pile that is due again within this long (0 = always disconnect)
+breakerThreshold = 3 #failed cycles in a row before a pile is left alone
+breakerCooldown = 1800 #secs - first time a pile is left alone, doubled each time after
+breakerCooldownMax = 21600 #secs
+
+#Split processes - an ingest process only talks BLE and appends raw samples to a queue on disk
+#(sampleQueue.py); an analyzer process (python getReadings.py analyzer) stores and analyzes them in batches
+splitProcesses = False #True = this process does the ingest and starts the analyzer; python getReadings.py ingest does the ingest only
+queueFolder = 'queue' #queue/samples from ingest, queue/commands (vent, pump, poll interval) back from the analyzer
+analyzerBatchSize = 100 #samples per transaction
+analyzerPollInterval = 1.0 #secs between looks at an empty queue
+commandWait = 5 #secs ingest stays connected for the vent and pump settings of a sample; later ones are dropped
+
+#Background scanner
+scanPeriod = 4.0 #secs per scan pass
+passiveScan = False #uses less power, but only sees names sent in the advertisement itself, not in scan responses
+discoveryTTL = 900 #secs - a device not heard from for this long is dropped from the discovery cache
+discoveryWait = 10 #secs getMAC waits for a device that hasn't been discovered yet
+rssiHistoryLength = 20 #RSSI samples kept per device
+
 #*************************************************************
 #Compost Analysis Settings
 #*************************************************************
 database = 'smart_compost.db'
+store = CompostStore(database)
 json_output = '/www/pages/currentReadings.json'
-now_epoch = time.time()
-today = datetime.today() 
+fleet_json_output = '/www/pages/fleetReadings.json' #every pile, keyed by device ID (fleet mode)
+dashboardPile = None #fleet mode: the pile in json_output and the page's updates; None = the first pile by device ID
+uiServerPort = 8080 #dashboard and live updates (GET /events); 0 turns the server off
+ingestMetricsPort = 8081 #split processes: the ingest process serves its own /metrics (scans, connections, reads) here; 0 = off
+rulesFile = 'pileRules.json' #limits and alert rules per pile or recipe (see Alert rules below); optional, read again when it changes
+metricsFile = '' #Prometheus text rewritten after every poll (node_exporter textfile collector); empty = /metrics only
+tableRowsInterval = 3600 #secs between the table_rows gauges' counts, each one a full table scan
+uiServerRoot = os.path.dirname(json_output) #where index.html and the JSON files live
 daysWhenReady = 35
 daysAtSafeTempLevel = 25
 baselineTemp = 140
@@ -57,6 +263,21 @@ ambientTempCold = 40 #degrees F
 width = 25 #in cm
 length = 10 # cm
 partOfVolumeEq = width * length
+scrapMedianWindow = 5 #KitchenBin samples in the median filter
+scrapDeadband = 2 #cm - smaller changes of the filtered level are ignored
+scrapEmptySamples = 2 #low samples in a row before the bin counts as emptied
+scrapRefillLevel = 3 #cm - the bin must fill to this level before it can be emptied again
+scrapFlushInterval = 900 #secs - level changes are saved at most this often...
+scrapFlushSize = 20 #...or after this many changes
+trendWindowDays = 4 #today and the 3 days before it
+trendDecay = None #set to e.g. 0.7 to weight recent days exponentially more than older ones
+
+#Retention - raw readings are compacted into hourly rows, hourly rows into daily rows
+rawRetentionDays = 30
+hourlyRetentionDays = 365
+compactionInterval = 86400 #secs - 1 day
+archiveFolder = 'archive' #finished piles are moved to archive/<device>-<date>.db
+exportFolder = '' #if set, new readings are exported to column files here (historyExport.py) before each compaction
 
 #Limits--------
 tempDanger = 175
@@ -67,6 +288,8 @@ moistHigh = 60
 moistLow = 40
 scrapHigh = 20
 scrapMedium = 10
+methaneHigh = 50000 #ppm
+methaneMedium = 10000
 
 
 #Return Values
@@ -105,6 +328,131 @@ success = "alert alert-success"
 info = "alert alert-info"
 warning = "alert alert-warning"
 danger = "alert alert-danger"
+alertLevels = [success, info, warning, danger] #evaluateReading(s) return indexes into this list
+SUCCESS, INFO, WARNING, DANGER = 0, 1, 2, 3
+
+#*************************************************************
+#Alert rules: evaluateReading looks the temperature, moisture, scrap,
+#water and methane alerts up in rule tables (ruleEngine.py). The defaults
+#below are the original branches with the limits above. rulesFile changes
+#limits and tables for every pile, for a recipe or for one pile:
+#   {"limits": {"tempHigh": 155},
+#    "rules": {"moisture": [...]},
+#    "recipes": {"leaves": {"limits": {"moistLow": 45}}},
+#    "piles": {"fa:ce:01:00:00:00": {"recipe": "leaves", "limits": {"tempOK": 135}}}}
+#Later layers win; a table in "rules" replaces the default table. The file
+#is read again when it changes. A file with errors is reported and the
+#rules from before stay in use
+#*************************************************************
+ruleLimitNames = ["tempDanger", "tempHigh", "tempOK", "tempLow", "moistHigh", "moistLow", "scrapHigh", "scrapMedium", "methaneHigh", "methaneMedium"]
+alertNames = {"success":SUCCESS, "info":INFO, "warning":WARNING, "danger":DANGER}
+
+#A moisture message replaces the temperature message if its priority is higher (lower number),
+#or is shown next to it if the priorities are the same and it has "append"
+defaultRules = {
+    "temperature": [
+        {"when":{"value":{"above":"tempDanger"}}, "alert":"danger", "message":3, "priority":1, "vent":1, "water":1},
+        {"when":{"value":{"above":"tempHigh"}}, "alert":"danger", "message":4, "priority":1, "vent":1, "water":1},
+        {"when":{"value":{"above":"tempOK"}, "trend":{"below":1}}, "alert":"warning", "message":5, "priority":2, "vent":1},
+        {"when":{"value":{"above":"tempOK"}}, "alert":"warning", "message":6, "priority":2},
+        {"when":{"value":{"above":"tempLow"}}, "alert":"success", "message":7, "priority":3},
+        {"when":{"trend":{"above":0}}, "alert":"warning", "message":8, "priority":2, "vent":0},
+        {"when":{"ambient":"low"}, "alert":"danger", "message":10, "priority":1, "vent":0},
+        {"alert":"warning", "message":9, "priority":2, "vent":0}],
+    "moisture": [
+        {"when":{"value":{"above":"moistHigh"}, "trend":{"atLeast":0}}, "alert":"danger", "message":0, "priority":1, "vent":1},
+        {"when":{"value":{"above":"moistHigh"}}, "alert":"warning", "message":1, "priority":2, "vent":1, "append":True},
+        {"when":{"value":{"above":"moistLow"}}, "alert":"success"},
+        {"when":{"trend":{"below":1}}, "alert":"danger", "message":4, "priority":1, "vent":0, "water":1},
+        {"alert":"warning", "message":3, "priority":2, "water":1, "append":True}],
+    "scrap": [
+        {"when":{"value":{"above":"scrapHigh"}}, "alert":"danger"},
+        {"when":{"value":{"above":"scrapMedium"}}, "alert":"warning"},
+        {"alert":"success"}],
+    "water": [
+        {"when":{"value":{"atMost":0}}, "alert":"danger"},
+        {"alert":"success"}],
+    "methane": [
+        {"when":{"value":{"above":"methaneHigh"}}, "alert":"danger"},
+        {"when":{"value":{"above":"methaneMedium"}}, "alert":"warning"},
+        {"alert":"success"}]}
+
+ruleMessages = {"temperature":tempMessageArray, "moisture":moistureMessageArray} #what a rule's message indexes; the other tables have none
+
+class PileRules(object): #the limits and compiled tables of one pile
+    def __init__(self, limits, rules):
+        self.limits = limits
+        self.rules = rules
+        self.tables = dict((name, ruleEngine.RuleTable(name, rules[name], limits, alertNames, ruleMessages.get(name, []))) for name in defaultRules)
+
+class RuleBook(object):
+    def __init__(self):
+        self.config = {}
+        self.mtime = None #of the rules in use; a file that failed to load is read again until it loads
+        self.failedMtime = None #only reported once
+        self.piles = {} #device -> PileRules, compiled on first use
+        self.lock = threading.Lock()
+
+    def refresh(self): #reads rulesFile again if it changed
+        try:
+            mtime = os.path.getmtime(rulesFile)
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        config = {}
+        if mtime is not None:
+            try:
+                with io.open(rulesFile, "rb") as f:
+                    config = json.load(f)
+                for pile in [None] + config.get("piles", {}).values() + [{"recipe":name} for name in config.get("recipes", {})]:
+                    self.compile(config, pile) #errors show up now, not at the next reading of some pile
+            except (ValueError, KeyError, TypeError, AttributeError, IOError, OSError) as e: #half written, or gone since getmtime
+                if mtime != self.failedMtime:
+                    self.failedMtime = mtime
+                    print "Ignoring the changes to %s: %s" % (rulesFile, e)
+                    metrics.increment("exceptions_total", where="rules")
+                return
+            print "Loaded the rules in " + rulesFile
+        self.mtime = mtime
+        self.config = config
+        self.piles = {}
+
+    def compile(self, config, pile):
+        limits = dict((name, globals()[name]) for name in ruleLimitNames)
+        rules = dict(defaultRules)
+        layers = [config]
+        if pile is not None:
+            if pile.get("recipe") is not None:
+                if pile["recipe"] not in config.get("recipes", {}):
+                    raise ruleEngine.RuleError("unknown recipe " + pile["recipe"])
+                layers.append(config["recipes"][pile["recipe"]])
+            layers.append(pile)
+        for layer in layers:
+            for name, value in layer.get("limits", {}).items():
+                if name not in limits:
+                    raise ruleEngine.RuleError("unknown limit " + name)
+                if not isinstance(value, (int, long, float)) or isinstance(value, bool):
+                    raise ruleEngine.RuleError("limit %s must be a number" % name)
+                limits[name] = value
+            rules.update(layer.get("rules", {}))
+        unknown = set(rules) - set(defaultRules)
+        if unknown:
+            raise ruleEngine.RuleError("unknown rule tables " + ", ".join(sorted(unknown)))
+        return PileRules(limits, rules)
+
+    def get(self, device):
+        with self.lock:
+            self.refresh()
+            rules = self.piles.get(device)
+            if rules is None:
+                rules = self.piles[device] = self.compile(self.config, self.config.get("piles", {}).get(device))
+            return rules
+
+ruleBook = RuleBook()
+
+def rulesFor(device=defaultDevice): #PileRules for the pile, from rulesFile as it is now
+    return ruleBook.get(device)
 	
 
 #*************************************************************
@@ -144,492 +492,1978 @@ validUUIDs[5].append("waterLevel")
 
 uuidCount = len(validUUIDs)
 
+compostServiceUUID = "0411dc90-895b-4639-b627-c663f6726c3c"
+ventAngleUUID = "0411dc97-895b-4639-b627-c663f6726c3c"
+startPumpUUID = "0411dc98-895b-4639-b627-c663f6726c3c"
+
+#All readings in one characteristic. Current firmware sends a packed struct, starting with
+#its format version; older firmware sends "tempF,ambientTempF,moisture,methane,waterLevel"
+#and the oldest doesn't have it at all and is read one characteristic at a time
+allReadingsUUID = "0411dc99-895b-4639-b627-c663f6726c3c"
+allReadingsFields = ["compostTempF", "ambientTempF", "compostMoisture", "methanePPM", "waterLevel"]
+#format version -> layout after the version byte: sequence number, sensor time (epoch secs), then
+#allReadingsFields - temperatures in 1/100 degrees F, moisture %, methane ppm, water level (19 bytes in all)
+packedReadingFormats = {1: struct.Struct("<IIhhBIB")}
+packedReadingScales = [0.01, 0.01, 1, 1, 1] #per allReadingsFields
+
+#*************************************************************
+#Analysis context: the inputs of a pile's analysis (trends, scraps, days)
+#are computed on first use and kept under what they are worked out from:
+#the day, the KitchenBin's latest event, the pile's state, the daily
+#averages in its trend window and its rules. Readings from a settled pile
+#often leave all of those as they were, so the context carries over to the
+#next reading; analyzeData, writeToUI and setIndicators share it, and a
+#reading with the same values as the last one reuses its evaluation
+#*************************************************************
+class AnalysisContext(object):
+    def __init__(self, device, key):
+        self.device = device
+        self.key = key
+        self.values = {} #name -> value, filled on first use
+
+    def lazy(self, name, function, *args):
+        if name not in self.values:
+            self.values[name] = function(*args)
+        return self.values[name]
+
+    def trend(self):
+        return self.lazy("trend", getTrendData, self.device)
+
+    def scrap(self):
+        return self.lazy("scrap", getScrapData)
+
+    def days(self):
+        return self.lazy("days", handleDateLogic, self.device)
+
+analysisContexts = {} #device -> AnalysisContext of its last analysis
+analysisContextsLock = threading.Lock()
+
+def analysisContext(device):
+    tempEstimator, moistEstimator = getTrendEstimators(device) #the rounded daily averages, as the trend sees them
+    pileState = getPileState(device)
+    key = (dayString(cycleToday()), scrapBuffer.version(), tuple(sorted(pileState.items())), tuple(tempEstimator.points), tuple(moistEstimator.points), rulesFor(device))
+    with analysisContextsLock:
+        context = analysisContexts.get(device)
+        if context is None or context.key != key:
+            context = analysisContexts[device] = AnalysisContext(device, key)
+        return context
+
 #*************************************************************
 #Main program to provide recommendations and update UI
 #*************************************************************
-def analyzeData(tempF, tempC, ambientTemp, moisture, methane, waterLevel):  
+def analyzeData(tempF, tempC, ambientTemp, moisture, methane, waterLevel, device=defaultDevice):  
+    analysisStart = time.time()
+    context = analysisContext(device)
+    inputs = (tempF, ambientTemp, moisture, methane, waterLevel)
 
     #get inputs for analysis
-    trendDataJSON = getTrendData()
-    scrapDataJSON = getScrapData()
-    days = handleDateLogic()
+    rules = context.key[-1]
+    trendDataJSON = context.trend()
+    scrapDataJSON = context.scrap()
+    days = context.days()
     
     lastScrapLevel = scrapDataJSON["lastScrapLevel"]
     totalScraps = scrapDataJSON["totalScraps"]
     
     tempTrend = trendDataJSON['tempTrend']
     moistTrend = trendDataJSON['moistTrend']
-        
-    tempAlert = info
-    moistAlert = info
-    methaneAlert = info
-    waterLevelAlert = info
-    scrapLevelAlert =  info
-    scrapLevelMsg = ""
-    waterLevelMsg = ""	
-    OverallMsg = tempMessageArray[0]
+
+    last = context.values.get("analysis")
+    if last is not None and last["inputs"] == inputs: #same reading with the same context, same recommendation
+        result, interval = last["result"], last["interval"]
+        metrics.increment("analysis_reused_total")
+    else:
+        result = evaluateReading(tempF, ambientTemp, moisture, methane, waterLevel, tempTrend, moistTrend, days, lastScrapLevel, rules)
+        interval = pollInterval(tempF, result, tempTrend, days, rules.limits)
+        context.values["analysis"] = {"inputs":inputs, "result":result, "interval":interval}
+    pollPlanner.analyzed(device, interval, interval <= pollIntervalMin)
+    OverallMsg = composeMessage(result["tempMsg"], result["moistMsg"])
+    waterLevelMsg = "Ok"
+    if result["waterLevelAlert"] == DANGER:
+        waterLevelMsg = "Refill"
+    scrapLevelMsg = ["Ok", "", "Empty soon", "Please empty"][result["scrapLevelAlert"]]
+    metrics.observe("stage_seconds", time.time() - analysisStart, stage="analysis") #writeToUI is timed on its own
+                                   
+    writeToUI(days, tempF, tempC, moisture, methane, waterLevelMsg, scrapLevelMsg, totalScraps, OverallMsg , alertLevels[result["tempAlert"]] , alertLevels[result["moistAlert"]] , alertLevels[result["methaneAlert"]] , alertLevels[result["waterLevelAlert"]], alertLevels[result["scrapLevelAlert"]], device, context)
+    setIndicators(context)
+    return (OverallMsg, result["ventAngle"], result["needWater"])
+
+def composeMessage(tempMsg, moistMsg): #message indexes (-1 = none) -> text for the UI
+    parts = []
+    if tempMsg >= 0:
+        parts.append(tempMessageArray[tempMsg])
+    if moistMsg >= 0:
+        parts.append(moistureMessageArray[moistMsg])
+    return " ".join(parts)
+
+#*************************************************************
+#Recommendation rules for one reading. No database or UI access, so it can
+#be replayed over history. Alerts are indexes into alertLevels, messages
+#are indexes into tempMessageArray/moistureMessageArray (-1 = not shown)
+#*************************************************************
+def levelAlert(table, value): #INFO if no rule matches
+    rule = table.lookup(value)
+    return INFO if rule is None else rule["alert"]
+
+def evaluateReading(tempF, ambientTemp, moisture, methane, waterLevel, tempTrend, moistTrend, days, lastScrapLevel, rules=None):
+    tables = (rules or rulesFor()).tables
+    tempAlert = INFO
+    moistAlert = INFO
+    tempMsg = 0
+    moistMsg = -1
     msgPriority = 3 #1 = trumps all other actions, #2 additive
 	
     ventAngle = 0
     needWater = 0
 	
-	#######################
-    #Handle Scrap Level
-    if lastScrapLevel > scrapHigh:
-        scrapLevelAlert = danger
-        scrapLevelMsg = "Please empty"
-    elif scrapHigh >= lastScrapLevel > scrapMedium:
-        scrapLevelAlert = warning
-        scrapLevelMsg = "Empty soon"
-    else:
-        scrapLevelAlert = success
-        scrapLevelMsg = "Ok"
-		
     #######################
-    #Handle Water Level
-    if waterLevel <= 0:
-        waterLevelMsg = "Refill"
-        waterLevelAlert = danger
-
-    else:
-        waterLevelMsg = "Ok"
-        waterLevelAlert = success
-            
-    #######################
-    #Handle Methane Level
-    if methane > 50000:
-        methaneAlert = danger
-    elif 50000 >= methane > 10000:
-        methaneAlert = warning
-    else:
-        methaneAlert = success
+    #Handle Scrap, Water and Methane Levels
+    scrapLevelAlert = levelAlert(tables["scrap"], lastScrapLevel)
+    waterLevelAlert = levelAlert(tables["water"], waterLevel)
+    methaneAlert = levelAlert(tables["methane"], methane)
 
 	#######################
     #Handle Temperature and Moisture
     if days >= daysWhenReady:
-        OverallMsg = tempMessageArray[1]
+        tempMsg = 1
         
     elif days >= daysAtSafeTempLevel:
-        OverallMsg = tempMessageArray[2]
+        tempMsg = 2
         
     else: # the compost is not ready
-    
-        ################################################################
-        #Handle Temperatures
-        if tempF > tempDanger:
-            needWater = 1
-            ventAngle = 1
-            tempAlert = danger
-            OverallMsg = tempMessageArray[3]
-            msgPriority = 1
-            
-        elif tempDanger >= tempF > tempHigh:
-            needWater = 1
-            ventAngle = 1
-            tempAlert = danger
-            OverallMsg = tempMessageArray[4]
-            msgPriority = 1
-            
-        elif tempHigh >= tempF > tempOK:
-
-            if tempTrend < 1:
-                ventAngle = 1
-                tempAlert = warning
-                OverallMsg = tempMessageArray[5]
-                msgPriority = 2
-            else:
-                tempAlert = warning
-                OverallMsg = tempMessageArray[6]
-                msgPriority = 2
-        
-        elif tempOK >= tempF > tempLow:
-            tempAlert = success
-            OverallMsg = tempMessageArray[7]
-            msgPriority = 3
-        
-        else:
-            ventAngle = 0
-            if tempTrend > 0:
-                tempAlert = warning
-                OverallMsg = tempMessageArray[8]
-                msgPriority = 2
-            else:
-                if ambientTemp =="low":
-                    tempAlert = danger
-                    OverallMsg = tempMessageArray[10]
-                    msgPriority = 1
-                else:
-                    tempAlert = warning
-                    OverallMsg = tempMessageArray[9]
-                    msgPriority = 2
-        
-        #######################################################################
-        #handle Moisture content
-        if moisture> moistHigh:
-            if moistTrend>=0:
-                moistAlert = danger
-                if msgPriority > 1: #this message will trump any other message besides temp priority 3
-                    OverallMsg = moistureMessageArray[0]
-                    ventAngle = 1
-                    msgPriority = 1
-            else:
-                moistAlert = warning
-                if msgPriority == 2: # this message is appended to any existing P2 messages
-                    OverallMsg = OverallMsg + " " + moistureMessageArray[1]
-                    ventAngle = 1
-                    msgPriority = 2
-                elif msgPriority == 3:#this message is replaces any P3 messages
-                    OverallMsg = moistureMessageArray[1]
-                    ventAngle = 1
-                    msgPriority = 2
-        elif moistHigh >=moisture> moistLow:
-            moistAlert = success
-        else:
-            if moistTrend<1:
-                moistAlert = danger
-                if msgPriority > 1: #this message will trump any other message besides priority 1
-                    OverallMsg = moistureMessageArray[4]
-                    ventAngle = 0
-                    needWater = 1
-                    msgPriority = 1
-            else:
-                moistAlert = warning
-                if msgPriority == 2: # this message is appended to any existing P2 messages
-                    OverallMsg = OverallMsg + " " + moistureMessageArray[3]
-                    needWater = 1
-                    msgPriority = 2
-                elif msgPriority == 3:#this message is replaces any P3 messages
-                    OverallMsg = moistureMessageArray[3]
-                    needWater = 1
-                    msgPriority = 2
-                                   
-    writeToUI(days, tempF, tempC, moisture, methane, waterLevelMsg, scrapLevelMsg, totalScraps, OverallMsg , tempAlert , moistAlert , methaneAlert , waterLevelAlert, scrapLevelAlert)
-    setIndicators()
-    return OverallMsg, ventAngle, needWater
+        rule = tables["temperature"].lookup(tempF, tempTrend, ambientTemp)
+        if rule is not None:
+            tempAlert = rule["alert"]
+            tempMsg = rule["message"] if rule["message"] is not None else tempMsg
+            msgPriority = rule["priority"] or msgPriority
+            ventAngle = rule["vent"] if rule["vent"] is not None else ventAngle
+            needWater = rule["water"] if rule["water"] is not None else needWater
 
+        rule = tables["moisture"].lookup(moisture, moistTrend)
+        if rule is not None:
+            moistAlert = rule["alert"]
+            show = False
+            if rule["message"] is not None and msgPriority > rule["priority"]: #this message trumps the temperature message
+                tempMsg = -1
+                msgPriority = rule["priority"]
+                show = True
+            elif rule["message"] is not None and msgPriority == rule["priority"] and rule["append"]: #appended to it
+                show = True
+            if show:
+                moistMsg = rule["message"]
+                ventAngle = rule["vent"] if rule["vent"] is not None else ventAngle
+                needWater = rule["water"] if rule["water"] is not None else needWater
 
+    return {"tempAlert":tempAlert, "moistAlert":moistAlert, "methaneAlert":methaneAlert, "waterLevelAlert":waterLevelAlert, "scrapLevelAlert":scrapLevelAlert,
+        "tempMsg":tempMsg, "moistMsg":moistMsg, "msgPriority":msgPriority, "ventAngle":ventAngle, "needWater":needWater}
+
+#*************************************************************
+#Batch version of evaluateReading for replaying history, e.g. to see which
+#alerts would have fired with different limits. Takes equal length columns
+#(or scalars) and returns a column per output of evaluateReading. Each
+#column is classified against the same compiled rule tables as
+#evaluateReading (RuleTable.lookupArrays), so both give identical results
+#for any rulesFile. Limits can be overridden by name on top of the pile's,
+#e.g. evaluateReadings(..., rules=rulesFor(device), tempHigh=150)
+#*************************************************************
+def evaluateReadings(tempF, ambientLow, moisture, methane, waterLevel, tempTrend, moistTrend, days, lastScrapLevel, rules=None, **limits):
+    import numpy as np #only needed here; it takes seconds to import on the Edison
+
+    rules = rules or rulesFor()
+    if [name for name in limits if name in ruleLimitNames]:
+        rules = PileRules(dict(rules.limits, **dict((name, value) for name, value in limits.items() if name in ruleLimitNames)), rules.rules)
+    tables = rules.tables
+
+    def limit(name):
+        return limits.get(name, globals()[name])
+
+    def outcome(table, match, key): #(value, set) of the outcome key for each match
+        values, isSet = table.outcomeArrays(key)
+        return values[match], isSet[match]
+
+    def levelAlerts(table, value):
+        match = table.lookupArrays(value)
+        alert, matched = outcome(table, match, "alert")
+        return np.where(matched, alert, INFO).astype(np.int8)
+
+    with np.errstate(invalid='ignore'): #missing (NaN) values compare False, as in evaluateReading
+        columns = np.broadcast_arrays(*[np.asarray(column, dtype=float) for column in [tempF, ambientLow, moisture, methane, waterLevel, tempTrend, moistTrend, days, lastScrapLevel]])
+        tempF, ambientLow, moisture, methane, waterLevel, tempTrend, moistTrend, days, lastScrapLevel = columns
+        ambientLow = ambientLow.astype(bool)
+        shape = tempF.shape
+
+        tempAlert = np.full(shape, INFO, dtype=np.int8)
+        moistAlert = np.full(shape, INFO, dtype=np.int8)
+        tempMsg = np.zeros(shape, dtype=np.int8)
+        moistMsg = np.full(shape, -1, dtype=np.int8)
+        msgPriority = np.full(shape, 3, dtype=np.int8)
+        ventAngle = np.zeros(shape, dtype=np.int8)
+        needWater = np.zeros(shape, dtype=np.int8)
+
+        #Scrap, water and methane levels
+        scrapLevelAlert = levelAlerts(tables["scrap"], lastScrapLevel)
+        waterLevelAlert = levelAlerts(tables["water"], waterLevel)
+        methaneAlert = levelAlerts(tables["methane"], methane)
+
+        #Readiness
+        ready = days >= limit("daysWhenReady")
+        curing = ~ready & (days >= limit("daysAtSafeTempLevel"))
+        active = ~ready & ~curing
+        tempMsg[ready] = 1
+        tempMsg[curing] = 2
+
+        #Temperatures
+        table = tables["temperature"]
+        match = table.lookupArrays(tempF, tempTrend, ambientLow)
+        matched = active & (match < len(table.rules))
+        alert, isSet = outcome(table, match, "alert")
+        tempAlert[matched] = alert[matched]
+        message, isSet = outcome(table, match, "message")
+        tempMsg[matched & isSet] = message[matched & isSet]
+        priority, isSet = outcome(table, match, "priority")
+        mask = matched & isSet & (priority != 0) #a priority of 0 keeps the current one, as "or" does
+        msgPriority[mask] = priority[mask]
+        for column, key in [(ventAngle, "vent"), (needWater, "water")]:
+            value, isSet = outcome(table, match, key)
+            column[matched & isSet] = value[matched & isSet]
+
+        #Moisture - the masks on msgPriority are taken before it is updated
+        table = tables["moisture"]
+        match = table.lookupArrays(moisture, moistTrend)
+        matched = active & (match < len(table.rules))
+        alert, isSet = outcome(table, match, "alert")
+        moistAlert[matched] = alert[matched]
+        message, hasMessage = outcome(table, match, "message")
+        priority, isSet = outcome(table, match, "priority")
+        appended, isSet = outcome(table, match, "append")
+        trump = matched & hasMessage & (msgPriority > priority)
+        show = trump | (matched & hasMessage & (msgPriority == priority) & appended.astype(bool))
+        tempMsg[trump] = -1
+        msgPriority[trump] = priority[trump]
+        moistMsg[show] = message[show]
+        for column, key in [(ventAngle, "vent"), (needWater, "water")]:
+            value, isSet = outcome(table, match, key)
+            column[show & isSet] = value[show & isSet]
+
+        return {"tempAlert":tempAlert, "moistAlert":moistAlert, "methaneAlert":methaneAlert, "waterLevelAlert":waterLevelAlert, "scrapLevelAlert":scrapLevelAlert,
+            "tempMsg":tempMsg, "moistMsg":moistMsg, "msgPriority":msgPriority, "ventAngle":ventAngle, "needWater":needWater}
 
 #*************************************************************
 #Function to get the scrap data. This us updated in a seperate function
+#Every level change and emptied bin is appended to scrapEvents (indexed by
+#time, for history and reports); kitchenScraps holds the one row of
+#current state - the last level and the running total - so reading it
+#never scans the history
 #*************************************************************    
 def getScrapData():
+    return scrapBuffer.current() #includes levels that haven't been flushed yet
 
+def loadScrapData(): #the last saved levels
 	#first we initialize the variables
     lastScrapLevel = 0
     totalScraps = 0
+    lastEventId = 0
 
     #then we get the last saved levels
-    conn = sqlite3.connect(database)
-    c = conn.cursor()
-    c.execute("SELECT lastScrapLevel, totalScraps from kitchenScraps")
-    rows = c.fetchall()
+    rows = store.query("SELECT lastScrapLevel, totalScraps, lastEventId from kitchenScraps LIMIT 1")
     for row in rows:
         lastScrapLevel = row[0]
         totalScraps = row[1]	
-    conn.commit()
-    c.close()
-    return {"lastScrapLevel":lastScrapLevel, "totalScraps":totalScraps} 
-	
-def getScrapDataFromSensor(scrapLevel):#save scrap data to database
+        lastEventId = row[2] or 0
+    return {"lastScrapLevel":lastScrapLevel, "totalScraps":totalScraps, "lastEventId":lastEventId} 
 	
-	#first we initialize the variables
-    lastScrapLevel = 0
-    totalScraps = 0
+def getScrapDataFromSensor(scrapLevel): #a level from the KitchenBin, buffered before it is saved
+    if sampleLog is not None: #split processes, the analyzer buffers it
+        sampleLog.append({"kind":"scrap", "datetime":time.time(), "level":scrapLevel})
+        return
+    scrapBuffer.add(scrapLevel)
 
-    #then we get the last saved levels
-    conn = sqlite3.connect(database)
-    c = conn.cursor()
-    c.execute("SELECT lastScrapLevel, totalScraps from kitchenScraps")
-    rows = c.fetchall()
-    for row in rows:
-        lastScrapLevel = row[0]
-        totalScraps = row[1]	
+def scrapLbs(scrapLevel): #lbs of scraps in a bin filled to scrapLevel cm
+    #300 lb = 1 cubic yard (loosly packed)
+    #1 cubic yard = 764555 cubic cm
+    return scrapLevel * partOfVolumeEq * (300.0/764555)
 
-    if scrapLevel <1: #scrap may have been emptied, get the last amount and add to total
-	    #300 lb = 1 cubic yard (loosly packed)
-		#1 cubic yard = 764555 cubic cm
-		#
-        lbsAdded = lastScrapLevel * partOfVolumeEq * (300/764555)
-        print lbsAdded
-        totalScraps = totalScraps + lbsAdded
-        scrapLevel = 0
-    
-    c.execute("DELETE FROM kitchenScraps");
-    c.execute("INSERT into kitchenScraps (lastScrapLevel, totalScraps) values (?, ?)", (scrapLevel, totalScraps))
-    conn.commit()
-    c.close()
-    
+def saveScrapData(lastScrapLevel, totalScraps, events=()):#save scrap data to database, returns the last event ID
+    #events = [(datetime, kind, level, lbsAdded, totalScraps), ...], kind is "level" or "emptied"
+    with store.transaction() as conn:
+        conn.executemany("INSERT into scrapEvents (datetime, kind, level, lbsAdded, totalScraps) values (?, ?, ?, ?, ?)", events)
+        lastEventId = conn.execute("SELECT coalesce(max(id), 0) FROM scrapEvents").fetchone()[0]
+        conn.execute("UPDATE kitchenScraps SET lastScrapLevel = ?, totalScraps = ?, lastEventId = ?", (lastScrapLevel, totalScraps, lastEventId))
+    return lastEventId
+
+scrapEventsTable = "CREATE TABLE IF NOT EXISTS scrapEvents (id INTEGER PRIMARY KEY, datetime INTEGER, kind TEXT, level NUMERIC, lbsAdded REAL, totalScraps REAL)"
+
+def getScrapsAdded(start, end, period="week"): #lbs emptied into the compost per week (or day, month) between two epochs
+    groupBy = {"day":"%Y-%m-%d", "week":"%Y-%W", "month":"%Y-%m"}[period]
+    return store.queryDicts("SELECT strftime(?, datetime, 'unixepoch', 'localtime') AS period, sum(lbsAdded) AS lbsAdded, count(*) AS emptied FROM scrapEvents WHERE kind = 'emptied' AND datetime >= ? AND datetime < ? GROUP BY period ORDER BY period", (groupBy, start, end))
+
+def getFillRate(start, end): #cm (and lbs) the bin filled by per day between two epochs
+    rows = store.query("SELECT level FROM scrapEvents WHERE datetime < ? ORDER BY datetime DESC LIMIT 1", (start,))
+    lastLevel = rows[0][0] if rows else None #no earlier level, the first one in range is where we start from
+    days = collections.OrderedDict()
+    for epoch, kind, level in store.query("SELECT datetime, kind, level FROM scrapEvents WHERE datetime >= ? AND datetime < ? ORDER BY datetime", (start, end)):
+        day = datetime.fromtimestamp(epoch).strftime("%Y-%m-%d")
+        days.setdefault(day, 0)
+        if kind == "emptied":
+            lastLevel = 0
+        else:
+            if lastLevel is not None:
+                days[day] += max(0, level - lastLevel) #a lower level is settling, not scraps taken out
+            lastLevel = level
+    return [{"day":date, "cmAdded":cm, "lbsAdded":scrapLbs(cm)} for date, cm in days.items()]
+
+#*************************************************************
+#Scrap buffer: the ultrasonic sensor is jittery and can notify many times
+#a minute. Levels are median filtered over the last few samples, small
+#changes are ignored, and the bin only counts as emptied after several low
+#samples in a row and once it has filled again since the last time - so a
+#bin standing empty can't add its scraps to totalScraps twice. Changes are
+#saved in one transaction every scrapFlushInterval secs or scrapFlushSize
+#changes; an emptied bin is saved right away
+#*************************************************************
+class ScrapBuffer(object): #the store is only called without self.lock held; a compost cycle holds store.lock and then takes self.lock
+    def __init__(self):
+        self.samples = collections.deque(maxlen=scrapMedianWindow)
+        self.state = None #{"lastScrapLevel", "totalScraps", "lastEventId"}, loaded from the database on first use
+        self.lowSamples = 0 #low samples in a row
+        self.armed = True #the bin has filled since it was last emptied
+        self.events = [] #scrapEvents rows not saved yet
+        self.changes = 0 #level and total changes, saved or not
+        self.flushScheduled = False
+        self.lock = threading.Lock()
+        self.writeLock = threading.Lock() #one save at a time, in order
+
+    def load(self):
+        if self.state is None:
+            state = loadScrapData()
+            with self.lock:
+                if self.state is None:
+                    self.state = state
+                    self.armed = state["lastScrapLevel"] >= scrapRefillLevel
+
+    def current(self):
+        self.load()
+        with self.lock:
+            return dict(self.state)
+
+    def version(self): #changes with every level or total change
+        self.load()
+        with self.lock:
+            return self.changes
+
+    def add(self, scrapLevel): #returns True if the level was saved
+        self.load()
+        with self.lock:
+            state = self.state
+            if scrapLevel < 1: #scrap may have been emptied
+                self.lowSamples += 1
+                if self.lowSamples < scrapEmptySamples or not self.armed:
+                    return False
+                lbsAdded = scrapLbs(state["lastScrapLevel"]) #get the last amount and add to total
+                print lbsAdded
+                state["totalScraps"] = state["totalScraps"] + lbsAdded
+                self.events.append((int(cycleEpoch()), "emptied", state["lastScrapLevel"], lbsAdded, state["totalScraps"]))
+                self.changes += 1
+                state["lastScrapLevel"] = 0
+                self.samples.clear()
+                self.armed = False
+                metrics.increment("scrap_emptied_total")
+                save = True
+            else:
+                self.lowSamples = 0
+                self.samples.append(scrapLevel)
+                level = sorted(self.samples)[len(self.samples) // 2]
+                if level >= scrapRefillLevel:
+                    self.armed = True
+                if abs(level - state["lastScrapLevel"]) < scrapDeadband:
+                    return False
+                state["lastScrapLevel"] = level
+                self.events.append((int(cycleEpoch()), "level", level, 0, state["totalScraps"]))
+                self.changes += 1
+                save = len(self.events) >= scrapFlushSize
+                if not save and not self.flushScheduled:
+                    self.flushScheduled = True
+                    scheduler.callSoon(scheduler.callLater, scrapFlushInterval, self.flush)
+        return save and self.save()
+
+    def flush(self): #saves unsaved changes (timer, shutdown)
+        with self.lock:
+            self.flushScheduled = False
+        return self.save()
+
+    def save(self):
+        with self.writeLock:
+            with self.lock: #take the unsaved changes, the store is written without the lock
+                if self.state is None or not self.events:
+                    return False
+                events, self.events = self.events, []
+                lastScrapLevel, totalScraps = self.state["lastScrapLevel"], self.state["totalScraps"]
+            try:
+                lastEventId = saveScrapData(lastScrapLevel, totalScraps, events)
+            except:
+                with self.lock:
+                    self.events[:0] = events #saved with the next flush
+                raise
+            with self.lock:
+                self.state["lastEventId"] = lastEventId
+        metrics.increment("scrap_flushes_total")
+        return True
+
+scrapBuffer = ScrapBuffer()
 
 #*************************************************************
 #Function to calculate trends: analyze historical data to determine if temp/moisture is rising or falling
 #*************************************************************    
-def getTrendData():
-    days = []
-    temps = []
-    moisture = []
-    conn = sqlite3.connect(database)
-    c = conn.cursor()
-    c.execute("SELECT round(AVG(tempF),0) AS avgTempF, round(AVG(moisture),0) AS avgMoisture, date(datetime, 'unixepoch', 'localtime') as day FROM readings GROUP BY date(datetime, 'unixepoch', 'localtime') order by day DESC LIMIT 7") #order by day ASC	
-    rows = c.fetchall()
-    for row in rows:
-        readingDay = datetime.strptime(row[2], "%Y-%m-%d")		
-        if abs((readingDay-today).days) <5: #we only want to look at records up to 4 days old
-            temps.append(row[0])
-            moisture.append(row[1])
-            days.append((readingDay-today).days + 5)
-    if len(days)>1:
-        tempTrend =  best_fit(days, temps)
-        moistTrend = best_fit(days, moisture)
-        best_fit(days, temps)		
-    else:
-        tempTrend = 0
-        moistTrend = 0
-    c.close()	
+def getTrendData(device=defaultDevice):
+    tempEstimator, moistEstimator = getTrendEstimators(device)
+    firstDay = cycleToday().toordinal() - trendWindowDays + 1 #we only want to look at records up to 4 days old
+    pileStart = datetime.strptime(getPileState(device)["pileStart"], "%Y-%m-%d").toordinal()
+    firstDay = max(firstDay, pileStart) #a new-pile run from another process leaves the old pile's days here
+    tempEstimator.expire(firstDay)
+    moistEstimator.expire(firstDay)
+    tempTrend = tempEstimator.slope()
+    moistTrend = moistEstimator.slope()
     return {"tempTrend":tempTrend,"moistTrend":moistTrend}
 
+def getTrendEstimators(device): #the first call per pile loads its last few daily averages, later days arrive through updateTrendEstimators
+    with store.lock:
+        if device not in trendEstimators:
+            trendEstimators[device] = (TrendEstimator(), TrendEstimator())
+            rows = store.query("SELECT round(sumTempF / tempCount, 0) AS avgTempF, round(sumMoisture / moistCount, 0) AS avgMoisture, day FROM dailyReadings WHERE device = ? AND day >= ? ORDER BY day DESC LIMIT ?", (device, getPileState(device)["pileStart"], trendWindowDays))
+            for row in reversed(rows):
+                updateTrendEstimators(device, row)
+        return trendEstimators[device]
+
+def updateTrendEstimators(device, row): #row = (avgTempF, avgMoisture, day) from dailyReadings
+    readingDay = datetime.strptime(row[2], "%Y-%m-%d").toordinal()
+    tempEstimator, moistEstimator = trendEstimators[device]
+    tempEstimator.update(readingDay, row[0])
+    moistEstimator.update(readingDay, row[1])
+
 #*************************************************************
 #Function to determine compost readiness
+#A pile goes heating (counting days above baselineTemp) -> curing
+#(daysAtSafeTempLevel hot days reached) -> ready (daysWhenReady days old).
+#The state is stored per pile in pileState and moves forward once for each
+#day that has closed, so the age is a lookup instead of a walk over every
+#daily average. startNewPile() starts a pile over
 #*************************************************************      
-def handleDateLogic(): 	
-    conn = sqlite3.connect(database)
-    c = conn.cursor()
-    c.execute('SELECT round(AVG(tempF),0) AS avgTempF, date(datetime, "unixepoch", "localtime") as day FROM readings GROUP BY date(datetime, "unixepoch", "localtime")') #order by day DESC	
-    rows = c.fetchall()
-    calcDaysAtSafeTempLevel = 0
-    for row in rows:
-        if row[0] > baselineTemp and calcDaysAtSafeTempLevel<= daysAtSafeTempLevel:
-            calcDaysAtSafeTempLevel+= 1
-            date = row[1] 
-            dateOfLastTemp = datetime.strptime(date, "%Y-%m-%d") #will need to read from database
-    
-    if calcDaysAtSafeTempLevel >= daysAtSafeTempLevel:
-        daysSince25th = abs((today - dateOfLastTemp).days) 
-        
-        return daysSince25th + daysAtSafeTempLevel       
+pileStateTable = "CREATE TABLE IF NOT EXISTS pileState (device TEXT PRIMARY KEY, state TEXT, pileStart TEXT, safeDays INTEGER, safeReachedDay TEXT, lastClosedDay TEXT)"
 
-    else:
-        return calcDaysAtSafeTempLevel
-            
+def dayString(d):
+    return d.strftime("%Y-%m-%d")
+
+def getPileState(device): #read every time, so a new-pile command from another process is seen
+    rows = store.queryDicts("SELECT * FROM pileState WHERE device = ?", (device,))
+    if rows:
+        return rows[0]
+    #no state yet - the pile started on its first day of readings and its history is counted once
+    firstDay = store.query("SELECT min(day) FROM dailyReadings WHERE device = ?", (device,))[0][0]
+    return {"device":device, "state":"heating", "pileStart":firstDay or dayString(cycleToday()), "safeDays":0, "safeReachedDay":None, "lastClosedDay":None}
+
+def savePileState(state):
+    store.execute("INSERT OR REPLACE into pileState (device, state, pileStart, safeDays, safeReachedDay, lastClosedDay) values (:device, :state, :pileStart, :safeDays, :safeReachedDay, :lastClosedDay)", state)
+
+def closeDays(state, today): #counts the days that closed since the last call, returns True if there were any
+    yesterday = dayString(datetime.strptime(today, "%Y-%m-%d") - timedelta(days=1))
+    if state["lastClosedDay"] is not None and state["lastClosedDay"] >= yesterday:
+        return False
+    rows = store.query("SELECT round(sumTempF / tempCount, 0) AS avgTempF, day FROM dailyReadings WHERE device = ? AND day >= ? AND day > ? AND day < ? ORDER BY day ASC", (state["device"], state["pileStart"], state["lastClosedDay"] or "", today))
+    for avgTempF, day in rows:
+        if state["state"] == "heating" and avgTempF is not None and avgTempF > baselineTemp:
+            state["safeDays"] += 1
+            if state["safeDays"] >= daysAtSafeTempLevel:
+                state["state"] = "curing"
+                state["safeReachedDay"] = day
+    state["lastClosedDay"] = yesterday
+    return True
+
+def handleDateLogic(device=defaultDevice): #days the pile has been composting
+    today = dayString(cycleToday())
+    with store.transaction():
+        state = getPileState(device)
+        changed = closeDays(state, today)
+        if state["state"] == "heating": #today counts too if its average so far is hot enough
+            days = state["safeDays"]
+            rows = store.query("SELECT round(sumTempF / tempCount, 0) FROM dailyReadings WHERE device = ? AND day = ?", (device, today))
+            if rows and rows[0][0] is not None and rows[0][0] > baselineTemp and today >= state["pileStart"]:
+                days += 1
+        else:
+            days = daysAtSafeTempLevel + (datetime.strptime(today, "%Y-%m-%d") - datetime.strptime(state["safeReachedDay"], "%Y-%m-%d")).days
+            if state["state"] == "curing" and days >= daysWhenReady:
+                state["state"] = "ready"
+                changed = True
+        if changed:
+            savePileState(state)
+    return days
+
+def startNewPile(device=defaultDevice, archive=False): #python getReadings.py new-pile [device] [--archive]
+    if archive: #the finished pile's history goes to its own database file
+        archivePile(device)
+    today = cycleToday()
+    state = {"device":device, "state":"heating", "pileStart":dayString(today), "safeDays":0, "safeReachedDay":None, "lastClosedDay":dayString(today - timedelta(days=1))}
+    with store.lock:
+        savePileState(state)
+        trendEstimators.pop(device, None) #the trend starts over with the new pile
+    print "Started a new pile for " + device
+    return state
     
 
 #*************************************************************
 #Function to write JSON of values for website
 #*************************************************************  		
-def writeToUI(days, tempF, tempC, moisture, methane, waterLevelMsg, scrapLevelMsg, totalScraps, messages , tempAlert , moistAlert , methaneAlert , waterLevelAlert, scrapLevelAlert): 
+@metrics.timed("stage_seconds", stage="ui")
+def writeToUI(days, tempF, tempC, moisture, methane, waterLevelMsg, scrapLevelMsg, totalScraps, messages , tempAlert , moistAlert , methaneAlert , waterLevelAlert, scrapLevelAlert, device=defaultDevice, context=None): 
+	payload = {"days":days, "tempF":tempF, "tempC":tempC, "moisture":moisture, "methane":methane, "waterLevelMsg":waterLevelMsg, "scrapLevelMsg":scrapLevelMsg, "totalScraps":totalScraps, "messages":messages, "tempAlert":tempAlert, "moistAlert":moistAlert, "methaneAlert":methaneAlert, "waterLevelAlert":waterLevelAlert, "scrapLevelAlert":scrapLevelAlert, "datetime":cycleEpoch(), "device":device}
 	#write values to database for UI
-	conn = sqlite3.connect(database)
-	c = conn.cursor()
-	c.execute("DELETE FROM ui");
-	c.execute("INSERT OR REPLACE into UI (days, tempF, tempC, moisture, methane, waterLevelMsg, scrapLevelMsg, totalScraps, messages , tempAlert , moistAlert , methaneAlert , waterLevelAlert, scrapLevelAlert, datetime)values (?, ?, ?, ?, ?, ?, ?, ?, ? , ? , ? , ? , ?, ?, ? )", (days, tempF, tempC, moisture, methane, waterLevelMsg, scrapLevelMsg, totalScraps, messages , tempAlert , moistAlert , methaneAlert , waterLevelAlert, scrapLevelAlert, now_epoch))
-	conn.commit()
-	#c.close()
-	
-	
-	#connection = sqlite3.connect(database)
-	conn.row_factory = dict_factory
-	c = conn.cursor()
-	c.execute("select * from ui")
-	# fetch all or one we'll go for all.
-	results = c.fetchall()
-	#print results[0]
-	conn.close()	
-	with io.open(json_output, 'w', encoding='utf-8') as f:
-	    f.write(json.dumps(results[0], ensure_ascii=False))
+	with store.transaction() as conn:
+	    conn.execute("DELETE FROM ui WHERE device = ?", (device,));
+	    conn.execute("INSERT OR REPLACE into UI (days, tempF, tempC, moisture, methane, waterLevelMsg, scrapLevelMsg, totalScraps, messages , tempAlert , moistAlert , methaneAlert , waterLevelAlert, scrapLevelAlert, datetime, device)values (?, ?, ?, ?, ?, ?, ?, ?, ? , ? , ? , ? , ?, ?, ?, ? )", (days, tempF, tempC, moisture, methane, waterLevelMsg, scrapLevelMsg, totalScraps, messages , tempAlert , moistAlert , methaneAlert , waterLevelAlert, scrapLevelAlert, payload["datetime"], device))
 	
+	uiPublisher.publish(device, payload)
+	if context is not None: #setIndicators gets what the UI shows without reading it back
+	    context.values["ui"] = payload
 	return 'ok'
+
+#*************************************************************
+#UI publisher: writes the JSON for the website from the payload in memory.
+#Files are replaced atomically (temp file + rename) so the page never reads
+#half a file, unchanged content is not rewritten, and a .meta.json sidecar
+#carries the ETag and Last-Modified for the page's conditional requests.
+#publish() only records a pile's payload; flush() writes the files and
+#pushes the changed piles once the cycle's transaction is over - after
+#each single pile poll, each fleet round and each analyzer batch - so a
+#fleet round writes fleetReadings.json once instead of once per pile
+#*************************************************************
+class UIPublisher(object):
+    def __init__(self):
+        self.piles = None #device -> payload, loaded from the ui table on first use
+        self.dirty = set() #devices published since the last flush
+        self.etags = {} #path -> ETag of the last write
+        self.lock = threading.Lock()
+        self.writeLock = threading.Lock() #one flush at a time; publish() only waits for self.lock
+
+    def publish(self, device, payload):
+        with self.lock:
+            if self.piles is None:
+                self.piles = {}
+                for row in store.queryDicts("select * from ui"):
+                    self.piles[row["device"]] = row
+            self.piles[device] = payload
+            self.dirty.add(device)
+
+    def dashboardDevice(self): #the pile json_output shows
+        if not fleetMode:
+            return defaultDevice
+        return dashboardPile or min(self.piles)
+
+    def flush(self): #called without a store transaction open
+        with self.writeLock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                dirty, self.dirty = self.dirty, set()
+                current = self.dashboardDevice()
+                piles = dict(self.piles)
+            if current in dirty and self.writeJSON(json_output, piles[current]):
+                dashboardServer.publish(piles[current]) #push to the open dashboards
+            if fleetMode: #every pile, keyed by device ID; the open dashboards get only the piles that changed
+                self.writeJSON(fleet_json_output, piles)
+                for device in dirty:
+                    dashboardServer.publish(piles[device], "pile", device)
+
+    def writeJSON(self, path, payload): #returns False if the file already had this content
+        body = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if self.etags.get(path) == etag:
+            return False
+        with metrics.timer("stage_seconds", stage="json_write"):
+            writeFileAtomically(path, body)
+            meta = {"etag":etag, "lastModified":formatdate(time.time(), usegmt=True), "length":len(body)}
+            writeFileAtomically(os.path.splitext(path)[0] + ".meta.json", json.dumps(meta))
+        self.etags[path] = etag
+        return True
+
+def writeFileAtomically(path, body):
+    tmp = path + ".tmp"
+    with io.open(tmp, 'wb') as f:
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path) #readers see the old file or the new one, never a mix
+
+uiPublisher = UIPublisher()
+dashboardServer = uiServer.UIServer(uiServerPort, uiServerRoot)
+dashboardServer.addRoute("/metrics", lambda: ("text/plain; version=0.0.4", metrics.render()))
+ingestMetricsServer = uiServer.UIServer(ingestMetricsPort, uiServerRoot) #the analyzer's dashboard server is in the other process
+ingestMetricsServer.addRoute("/metrics", lambda: ("text/plain; version=0.0.4", metrics.render()))
+metrics.gaugeFunction("sse_subscribers", dashboardServer.subscriberCount)
     
-def setIndicators(): #stub to set sensor data
+def setIndicators(context=None): #stub to set sensor data; context.values["ui"] holds the latest UI payload
     return 'ok'
 
 #*************************************************************
 #Function to write data to database
 #*************************************************************      
-def persistSensorData(tempF, tempC, ambientTempF, ambientTempC, moisture, methane, waterLevel): 
+@metrics.timed("stage_seconds", stage="persist")
+def persistSensorData(tempF, tempC, ambientTempF, ambientTempC, moisture, methane, waterLevel, device=defaultDevice, validFields=None): 
     #write values to database for trend analysis and history
-    conn = sqlite3.connect(database)
-    c = conn.cursor()
-    c.execute("INSERT into readings (tempF, tempC, ambientTempF, ambientTempC, moisture, methane, waterLevel, datetime)values (?, ?, ?, ?, ?, ?, ?, ?)", (tempF, tempC, ambientTempF, ambientTempC, moisture, methane, waterLevel, now_epoch))
-    conn.commit()
-    c.close()
+    #validFields has bit x set if allReadingsFields[x] was read (NULL = all of them); missing values are NULL
+    epoch = cycleEpoch()
+    with store.transaction() as conn:
+        conn.execute("INSERT into readings (tempF, tempC, ambientTempF, ambientTempC, moisture, methane, waterLevel, datetime, device, validFields)values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (tempF, tempC, ambientTempF, ambientTempC, moisture, methane, waterLevel, epoch, device, validFields))
+        updateDailyRollup(tempF, moisture, epoch, device)
+        if device in trendEstimators: #O(1) refresh of today's point in the trend sums
+            rows = store.query("SELECT round(sumTempF / tempCount, 0) AS avgTempF, round(sumMoisture / moistCount, 0) AS avgMoisture, day FROM dailyReadings WHERE device = ? AND day = date(?, 'unixepoch', 'localtime')", (device, epoch))
+            for row in rows:
+                updateTrendEstimators(device, row)
+    metrics.increment("readings_total")
     return 'ok'
 
 #*************************************************************
-#Function to determine slope of data points (for trend analysis)
-#*************************************************************      
-def best_fit(X,Y):
-    #Y = [141, 158]
-    #X = [-1, 0]	
-    x = np.array(X)
-    y = np.array(Y)	
-    A = np.vstack([x, np.ones(len(x))]).T
-    m, c = np.linalg.lstsq(A, y)[0]
-    return m
+#Daily rollup: one row per local day with the count, sum and min/max of
+#tempF and moisture. It is kept up to date as readings are written so the
+#trend and readiness logic never has to GROUP BY the full readings table
+#*************************************************************
+dailyRollupTable = """CREATE TABLE IF NOT EXISTS dailyReadings(device TEXT NOT NULL, day TEXT NOT NULL,
+    tempCount INTEGER, sumTempF REAL, minTempF NUMERIC, maxTempF NUMERIC,
+    moistCount INTEGER, sumMoisture REAL, minMoisture NUMERIC, maxMoisture NUMERIC,
+    PRIMARY KEY (device, day))"""
+
+def tableColumns(table):
+    return [row[1] for row in store.query("PRAGMA table_info(" + table + ")")]
+
+baseTables = [
+    "CREATE TABLE IF NOT EXISTS readings(tempF NUMERIC, tempC NUMERIC, ambientTempF NUMERIC, ambientTempC NUMERIC, moisture NUMERIC, methane NUMERIC, waterLevel NUMERIC, datetime INTEGER)",
+    "CREATE TABLE IF NOT EXISTS ui(days NUMERIC, tempF NUMERIC, tempC NUMERIC, moisture NUMERIC, methane NUMERIC, waterLevelMsg TEXT, scrapLevelMsg TEXT, totalScraps NUMERIC, messages TEXT, tempAlert TEXT, moistAlert TEXT, methaneAlert TEXT, waterLevelAlert TEXT, scrapLevelAlert TEXT, datetime INTEGER)",
+    "CREATE TABLE IF NOT EXISTS kitchenScraps (lastScrapLevel NUMERIC, totalScraps NUMERIC)"]
+
+def initDatabase():
+    for table in baseTables: #an empty database (new install, benchmark) gets the shipped schema
+        store.execute(table)
+    #readings and ui rows are namespaced by pile; rows written before fleet mode belong to defaultDevice
+    for table in ["readings", "ui"]:
+        if "device" not in tableColumns(table):
+            store.execute("ALTER TABLE " + table + " ADD COLUMN device TEXT NOT NULL DEFAULT '" + defaultDevice + "'")
+    if "validFields" not in tableColumns("readings"):
+        store.execute("ALTER TABLE readings ADD COLUMN validFields INTEGER")
+    if "id" not in tableColumns("readings"):
+        migrateReadingIds()
+    rollupColumns = tableColumns("dailyReadings")
+    if rollupColumns and "device" not in rollupColumns:
+        store.execute("DROP TABLE dailyReadings") #rollup from before fleet mode, rebuilt below
+        rollupColumns = []
+    store.execute(downsampledTable)
+    store.execute("CREATE INDEX IF NOT EXISTS readingsByDevice ON readings (device, datetime)")
+    store.execute(dailyRollupTable)
+    store.execute(pileStateTable)
+    store.execute(queueOffsetsTable)
+    store.execute(sensorHistoryTable)
+    if "bootId" not in tableColumns("sensorHistory"):
+        store.execute("ALTER TABLE sensorHistory ADD COLUMN bootId INTEGER")
+    if not rollupColumns: #first run against an existing database, backfill from history
+        rebuildDailyReadings()
+    #scrap history, and kitchenScraps as its one row of current state (updated in place)
+    store.execute(scrapEventsTable)
+    store.execute("CREATE INDEX IF NOT EXISTS scrapEventsByTime ON scrapEvents (datetime)")
+    if "lastEventId" not in tableColumns("kitchenScraps"):
+        store.execute("ALTER TABLE kitchenScraps ADD COLUMN lastEventId INTEGER")
+    if not store.query("SELECT 1 FROM kitchenScraps LIMIT 1"):
+        store.execute("INSERT into kitchenScraps (lastScrapLevel, totalScraps, lastEventId) values (0, 0, 0)")
+    return 'ok'
+
+readingFields = "tempF, tempC, ambientTempF, ambientTempC, moisture, methane, waterLevel, datetime, device, validFields"
+
+def migrateReadingIds(): #readings get an AUTOINCREMENT id, so rows archived or compacted away never have their ids reused
+    with store.transaction() as c:
+        c.execute("CREATE TABLE readingsById(id INTEGER PRIMARY KEY AUTOINCREMENT, tempF NUMERIC, tempC NUMERIC, ambientTempF NUMERIC, ambientTempC NUMERIC, moisture NUMERIC, methane NUMERIC, waterLevel NUMERIC, datetime INTEGER, device TEXT NOT NULL DEFAULT '" + defaultDevice + "', validFields INTEGER)")
+        c.execute("INSERT into readingsById (id, " + readingFields + ") SELECT rowid, " + readingFields + " FROM readings") #same ids, so the export checkpoint still holds
+        c.execute("DROP TABLE readings")
+        c.execute("ALTER TABLE readingsById RENAME TO readings")
+        lastId = c.execute("SELECT coalesce(max(id), 0) FROM readings").fetchone()[0]
+        if exportFolder: #ids already exported may have been deleted (and would have been reused)
+            import historyExport
+            lastId = max(lastId, historyExport.loadCheckpoint(exportFolder)["lastRowid"])
+        c.execute("DELETE FROM sqlite_sequence WHERE name = 'readings'")
+        c.execute("INSERT into sqlite_sequence (name, seq) values ('readings', ?)", (lastId,))
+
+def updateDailyRollup(tempF, moisture, epoch, device=defaultDevice):
+    values = {"tempF":tempF, "moisture":moisture, "datetime":epoch, "device":device}
+    with store.transaction() as c: #joins the caller's transaction so the rollup commits with the reading
+        c.execute("INSERT OR IGNORE into dailyReadings (device, day, tempCount, sumTempF, moistCount, sumMoisture) values (:device, date(:datetime, 'unixepoch', 'localtime'), 0, 0, 0, 0)", values)
+        c.execute("""UPDATE dailyReadings SET
+            tempCount = tempCount + (:tempF IS NOT NULL),
+            sumTempF = sumTempF + coalesce(:tempF, 0),
+            minTempF = CASE WHEN :tempF IS NULL THEN minTempF WHEN minTempF IS NULL OR :tempF < minTempF THEN :tempF ELSE minTempF END,
+            maxTempF = CASE WHEN :tempF IS NULL THEN maxTempF WHEN maxTempF IS NULL OR :tempF > maxTempF THEN :tempF ELSE maxTempF END,
+            moistCount = moistCount + (:moisture IS NOT NULL),
+            sumMoisture = sumMoisture + coalesce(:moisture, 0),
+            minMoisture = CASE WHEN :moisture IS NULL THEN minMoisture WHEN minMoisture IS NULL OR :moisture < minMoisture THEN :moisture ELSE minMoisture END,
+            maxMoisture = CASE WHEN :moisture IS NULL THEN maxMoisture WHEN maxMoisture IS NULL OR :moisture > maxMoisture THEN :moisture ELSE maxMoisture END
+            WHERE device = :device AND day = date(:datetime, 'unixepoch', 'localtime')""", values)
+
+def rebuildDailyReadings(): #backfill the rollup from the raw readings (python getReadings.py rebuild-daily)
+    with store.transaction() as c:
+        c.execute(dailyRollupTable)
+        c.execute("DELETE FROM dailyReadings")
+        #raw readings plus whatever retention has already compacted
+        c.execute("""INSERT into dailyReadings (device, day, tempCount, sumTempF, minTempF, maxTempF, moistCount, sumMoisture, minMoisture, maxMoisture)
+            SELECT device, day, sum(tempCount), total(sumTempF), min(minTempF), max(maxTempF), sum(moistCount), total(sumMoisture), min(minMoisture), max(maxMoisture) FROM (
+                SELECT device, date(datetime, 'unixepoch', 'localtime') as day, count(tempF) as tempCount, total(tempF) as sumTempF, min(tempF) as minTempF, max(tempF) as maxTempF, count(moisture) as moistCount, total(moisture) as sumMoisture, min(moisture) as minMoisture, max(moisture) as maxMoisture
+                FROM readings GROUP BY device, date(datetime, 'unixepoch', 'localtime')
+                UNION ALL
+                SELECT device, date(start, 'unixepoch', 'localtime'), tempFCount, tempFSum, tempFMin, tempFMax, moistureCount, moistureSum, moistureMin, moistureMax
+                FROM readingsDownsampled)
+            GROUP BY device, day""")
+    trendEstimators.clear()
+    dayCount = store.query("SELECT count(*) FROM dailyReadings")[0][0]
+    print "Rebuilt daily rollup: " + str(dayCount) + " days"
+    return dayCount
+
+#*************************************************************
+#Retention: raw readings older than rawRetentionDays are compacted into one
+#row per pile and hour, and hourly rows older than hourlyRetentionDays into
+#one row per pile and local day. Downsampled rows keep count, sum, min and
+#max of every metric, so rows can be merged and avg = sum / count. The
+#dailyReadings rollup is never compacted, so trends and readiness read
+#the same data before and after compaction
+#*************************************************************
+downsampledMetrics = ["tempF", "tempC", "ambientTempF", "ambientTempC", "moisture", "methane", "waterLevel"]
+downsampledColumns = []
+downsampledColumnTypes = []
+for metric in downsampledMetrics:
+    downsampledColumns += [metric + "Count", metric + "Sum", metric + "Min", metric + "Max"]
+    downsampledColumnTypes += [metric + "Count INTEGER", metric + "Sum REAL", metric + "Min NUMERIC", metric + "Max NUMERIC"]
+
+downsampledTable = "CREATE TABLE IF NOT EXISTS readingsDownsampled(device TEXT NOT NULL, period TEXT NOT NULL, start INTEGER NOT NULL, " + \
+    ", ".join(downsampledColumnTypes) + ", PRIMARY KEY (device, period, start))"
+
+def mergeDownsampled(c, device, period, start, values): #values in downsampledColumns order
+    c.execute("INSERT OR IGNORE into readingsDownsampled (device, period, start) values (?, ?, ?)", (device, period, start))
+    assignments = []
+    for metric in downsampledMetrics:
+        assignments += [metric + "Count = coalesce(" + metric + "Count, 0) + ?",
+            metric + "Sum = coalesce(" + metric + "Sum, 0) + ?",
+            metric + "Min = CASE WHEN ? IS NULL THEN " + metric + "Min WHEN " + metric + "Min IS NULL OR ? < " + metric + "Min THEN ? ELSE " + metric + "Min END",
+            metric + "Max = CASE WHEN ? IS NULL THEN " + metric + "Max WHEN " + metric + "Max IS NULL OR ? > " + metric + "Max THEN ? ELSE " + metric + "Max END"]
+    params = []
+    for x in range(0, len(downsampledMetrics)):
+        count, total, low, high = values[x * 4:x * 4 + 4]
+        params += [count, total, low, low, low, high, high, high]
+    c.execute("UPDATE readingsDownsampled SET " + ", ".join(assignments) + " WHERE device = ? AND period = ? AND start = ?", params + [device, period, start])
+
+def compactReadings(now=None):
+    if now is None:
+        now = time.time()
+    rawCutoff = int(now - rawRetentionDays * 86400) // 3600 * 3600 #whole hours only
+    aggregates = []
+    for metric in downsampledMetrics:
+        aggregates += ["count(" + metric + ")", "total(" + metric + ")", "min(" + metric + ")", "max(" + metric + ")"]
+    with store.transaction() as c:
+        rows = c.execute("SELECT device, CAST(datetime / 3600 AS INTEGER) * 3600 AS hour, " + ", ".join(aggregates) +
+            " FROM readings WHERE datetime < ? GROUP BY device, hour", (rawCutoff,)).fetchall()
+        for row in rows:
+            mergeDownsampled(c, row[0], "hour", row[1], row[2:])
+        c.execute("DELETE FROM readings WHERE datetime < ?", (rawCutoff,))
+
+        hourCutoff = int(now - hourlyRetentionDays * 86400)
+        hourRows = c.execute("SELECT device, start, " + ", ".join(downsampledColumns) +
+            " FROM readingsDownsampled WHERE period = 'hour' AND start < ?", (hourCutoff,)).fetchall()
+        for row in hourRows:
+            dayStart = int(time.mktime(datetime.fromtimestamp(row[1]).date().timetuple())) #local midnight
+            mergeDownsampled(c, row[0], "day", dayStart, row[2:])
+        c.execute("DELETE FROM readingsDownsampled WHERE period = 'hour' AND start < ?", (hourCutoff,))
+    print "Compacted " + str(len(rows)) + " raw hours and " + str(len(hourRows)) + " hourly rows"
+    return len(rows), len(hourRows)
+
+def archivePile(device): #moves everything stored for a finished pile into its own database file
+    if not os.path.isdir(archiveFolder):
+        os.makedirs(archiveFolder)
+    path = os.path.join(archiveFolder, device.replace(":", "") + "-" + datetime.today().strftime("%Y%m%d") + ".db")
+    with store.lock:
+        store.execute("ATTACH DATABASE ? AS archive", (path,))
+        try:
+            with store.transaction() as c:
+                for table in ["readings", "readingsDownsampled", "dailyReadings", "pileState"]:
+                    c.execute("CREATE TABLE IF NOT EXISTS archive." + table + " AS SELECT * FROM main." + table + " WHERE 0")
+                    c.execute("INSERT into archive." + table + " SELECT * FROM main." + table + " WHERE device = ?", (device,))
+                    c.execute("DELETE FROM main." + table + " WHERE device = ?", (device,))
+        finally:
+            store.execute("DETACH DATABASE archive")
+        trendEstimators.pop(device, None)
+    print "Archived pile " + device + " to " + path
+    return path
+
+#*************************************************************
+#Online trend estimator: keeps the least squares sums (n, Sx, Sy, Sxy, Sxx)
+#for one metric over a sliding window of days. Adding a point is O(1); a
+#second value for the newest day replaces the first one. With decay set,
+#every older day is weighted by decay**age (exponentially weighted mode)
+#*************************************************************
+class TrendEstimator(object):
+    def __init__(self, window=trendWindowDays, decay=trendDecay):
+        self.window = window
+        self.decay = decay
+        self.points = collections.deque() #(day, value)
+        self.reset()
+
+    def reset(self):
+        self.points.clear()
+        self.origin = None #x is stored relative to the first day to keep the sums small
+        self.n = self.sx = self.sy = self.sxy = self.sxx = 0.0
+
+    def weight(self, day):
+        if self.decay is None:
+            return 1.0
+        return self.decay ** (self.points[-1][0] - day)
+
+    def add(self, day, value, w):
+        x = day - self.origin
+        self.n += w
+        self.sx += w * x
+        self.sy += w * value
+        self.sxy += w * x * value
+        self.sxx += w * x * x
+
+    def update(self, day, value):
+        if value is None:
+            return
+        if self.points and day < self.points[-1][0]:
+            return #only the newest day can change
+        if self.points and self.points[-1][0] == day:
+            self.add(day, self.points.pop()[1], -1.0)
+        elif self.points and self.decay is not None:
+            scale = self.decay ** (day - self.points[-1][0])
+            self.n *= scale
+            self.sx *= scale
+            self.sy *= scale
+            self.sxy *= scale
+            self.sxx *= scale
+        if not self.points:
+            self.reset()
+            self.origin = day
+        self.points.append((day, value))
+        self.add(day, value, 1.0)
+        if self.window is not None:
+            self.expire(day - self.window + 1)
+
+    def expire(self, firstDay):
+        while self.points and self.points[0][0] < firstDay:
+            if len(self.points) == 1:
+                self.reset()
+                return
+            day, value = self.points[0]
+            self.add(day, value, -self.weight(day))
+            self.points.popleft()
+
+    def slope(self):
+        if len(self.points) < 2:
+            return 0
+        denom = self.n * self.sxx - self.sx * self.sx
+        if denom == 0:
+            return 0
+        return (self.n * self.sxy - self.sx * self.sy) / denom
+
+trendEstimators = {} #device -> (temp estimator, moisture estimator)
 
 #*************************************************************
 #Function to determine BTLE devices available
 #*************************************************************    
-class ScanDelegate(DefaultDelegate):
-    def __init__(self):
-        DefaultDelegate.__init__(self)
+class ScanDelegate(object): #bluepy only calls handleDiscovery, so no need to import its DefaultDelegate
+    def __init__(self, cache=None):
+        self.cache = cache
 
     def handleDiscovery(self, dev, isNewDev, isNewData):
         if isNewDev:
             print "Discovered device", dev.addr
-        elif isNewData:
-            print "Received new data from", dev.addr
+        if self.cache is not None:
+            name = dev.getValueText(9) #Complete Local Name
+            if name is not None:
+                self.cache.update(name, dev.addr, dev.addrType, dev.rssi)
+
+#*************************************************************
+#Discovery cache: name -> MAC, address type, RSSI and when the device was
+#last seen. The background scanner keeps it filled, so finding a device
+#is a dictionary lookup instead of a 4 second scan
+#*************************************************************
+class DiscoveryCache(object):
+    def __init__(self, ttl=discoveryTTL):
+        self.ttl = ttl
+        self.devices = {} #name -> {MAC: {"addrType", "rssi", "lastSeen"}}
+        self.rssi = {} #MAC -> deque of (time, rssi)
+        self.condition = threading.Condition()
 
+    def update(self, name, MAC, addrType, rssi):
+        with self.condition:
+            now = time.time()
+            self.devices.setdefault(name, {})[MAC] = {"addrType":addrType, "rssi":rssi, "lastSeen":now}
+            self.rssi.setdefault(MAC, collections.deque(maxlen=rssiHistoryLength)).append((now, rssi))
+            self.condition.notifyAll()
+
+    def evict(self):
+        with self.condition:
+            oldest = time.time() - self.ttl
+            for name in self.devices.keys():
+                for MAC, entry in self.devices[name].items():
+                    if entry["lastSeen"] < oldest:
+                        del self.devices[name][MAC]
+                        self.rssi.pop(MAC, None)
+                if not self.devices[name]:
+                    del self.devices[name]
+
+    def lookupAll(self, name, wait=0): #MACs with the name, best signal first
+        deadline = time.time() + wait
+        with self.condition:
+            self.evict()
+            while name not in self.devices and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+                self.evict()
+            entries = self.devices.get(name, {})
+            return sorted(entries.keys(), key=lambda MAC: -entries[MAC]["rssi"])
+
+    def lookup(self, name, wait=0): #MAC with the best signal, or None
+        MACs = self.lookupAll(name, wait)
+        if MACs:
+            return MACs[0]
+        return None
+
+    def entry(self, name, MAC):
+        with self.condition:
+            return dict(self.devices.get(name, {}).get(MAC, {}))
+
+    def rssiHistory(self, MAC): #[(time, rssi), ...] oldest first
+        with self.condition:
+            return list(self.rssi.get(MAC, []))
+
+class BackgroundScanner(object):
+    def __init__(self, cache):
+        self.cache = cache
+        self.thread = None
+        self.connecting = 0
+        self.idle = threading.Condition()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def scanOnce(self, period=scanPeriod):
+        scanner = ble().Scanner().withDelegate(ScanDelegate(self.cache))
+        with metrics.timer("stage_seconds", stage="scan"):
+            scanner.scan(period, passive=passiveScan)
+        self.cache.evict()
+
+    def run(self):
+        while True:
+            with self.idle:
+                while self.connecting > 0: #many adapters can't scan and connect at the same time
+                    self.idle.wait(1.0)
+            try:
+                self.scanOnce()
+            except Exception as e:
+                print "Scan failed: " + str(e)
+                metrics.increment("exceptions_total", where="scan")
+                time.sleep(scanPeriod)
+
+    @contextlib.contextmanager
+    def paused(self): #wrap connection setup so it doesn't compete with a scan pass
+        with self.idle:
+            self.connecting += 1
+        try:
+            yield
+        finally:
+            with self.idle:
+                self.connecting -= 1
+                self.idle.notifyAll()
+
+discoveryCache = DiscoveryCache()
+discoveryScanner = BackgroundScanner(discoveryCache)
 
-class MyDelegate(DefaultDelegate):
-    def __init__(self):
-        DefaultDelegate.__init__(self)
 
+class MyDelegate(object): #bluepy only calls handleNotification
     def handleNotification(self, cHandle, data):
         print("A notification was received: %s" %data)
 
 
-        val = binascii.b2a_hex(data)
-        val = binascii.unhexlify(val)
-        val = str(val).strip()
-        val = int(val)
-        getScrapDataFromSensor(val)
+        val = int(str(data).strip()) #the KitchenBin sends the level as ASCII
+        metrics.increment("notifications_total")
+        scheduler.callSoon(getScrapDataFromSensor, val) #buffered by the event loop, not the listener thread
         print "Amount in bin : "  + str(val)
 			
-def connectToDevice(MAC):
-    p = Peripheral(MAC) #p = Peripheral("98:4f:ee:0f:84:1f")
+#*************************************************************
+#Characteristic cache: the compost service is discovered once per pile and
+#the value handles are kept, so later connections read and write by handle
+#instead of running a GATT discovery for every UUID
+#*************************************************************
+class CharacteristicCache(object):
+    def __init__(self):
+        self.handles = {} #MAC -> {uuid: value handle}
+        self.lock = threading.Lock()
+
+    def getHandles(self, p, MAC):
+        with self.lock:
+            handles = self.handles.get(MAC)
+        if handles is None:
+            handles = {}
+            with metrics.timer("stage_seconds", stage="discovery"):
+                for ch in p.getServiceByUUID(compostServiceUUID).getCharacteristics():
+                    handles[str(ch.uuid).lower()] = ch.getHandle()
+            with self.lock:
+                self.handles[MAC] = handles
+        return handles
+
+    def forget(self, MAC): #handles can change with new firmware, rediscover on the next connection
+        with self.lock:
+            self.handles.pop(MAC, None)
+
+characteristicCache = CharacteristicCache()
+
+#*************************************************************
+#Pile sessions: one pile's connection for a cycle. Each GATT operation is
+#retried with exponential backoff on the same connection, and only if the
+#connection has dropped is the pile connected again. A connection can be
+#kept open for the next cycle if the pile is due again soon
+#*************************************************************
+class SessionCancelled(Exception):
+    pass
+
+def isConnected(p):
+    try:
+        return p.getState() == "conn"
+    except Exception:
+        return False
+
+class PileSession(object):
+    def __init__(self, MAC):
+        self.MAC = MAC
+        self.p = None
+        self.cancelled = False
+
+    def peripheral(self):
+        if self.p is not None and not isConnected(self.p):
+            self.disconnect()
+        if self.p is None:
+            with discoveryScanner.paused():
+                with metrics.timer("stage_seconds", stage="connect"):
+                    self.p = ble().Peripheral(self.MAC) #p = Peripheral("98:4f:ee:0f:84:1f")
+        return self.p
+
+    def call(self, what, function, *args): #function(peripheral, *args), retried readRetries times
+        delay = readRetryDelay
+        for attempt in range(0, readRetries + 1):
+            if self.cancelled:
+                raise SessionCancelled(self.MAC)
+            try:
+                return function(self.peripheral(), *args)
+            except Exception as e:
+                if attempt == readRetries or self.cancelled:
+                    raise
+                print "%s on %s failed (%s), retrying in %.1f secs" % (what, self.MAC, e, delay)
+                metrics.increment("retries_total", task=what)
+                time.sleep(delay)
+                delay = min(readRetryDelayMax, delay * 2)
+
+    def cancel(self): #from pollFleet when the pile takes too long
+        self.cancelled = True
+        self.disconnect()
+
+    def disconnect(self):
+        p, self.p = self.p, None
+        if p is not None:
+            try:
+                p.disconnect()
+            except Exception:
+                pass
+
+keptSessions = {} #MAC -> PileSession left connected for the next cycle
+keptSessionsLock = threading.Lock()
+
+def openSession(MAC):
+    with keptSessionsLock:
+        session = keptSessions.pop(MAC, None)
+    if session is None:
+        session = PileSession(MAC)
+    activeSessions[MAC] = session #lets pollFleet cancel a pile that hangs
+    return session
+
+def releaseSession(session, device):
+    activeSessions.pop(session.MAC, None)
+    pile = pollPlanner.piles.get(device)
+    if sessionKeepAlive and not session.cancelled and pile is not None and pile["interval"] <= sessionKeepAlive:
+        with keptSessionsLock:
+            keptSessions[session.MAC] = session
+    else:
+        session.disconnect()
+
+#*************************************************************
+#Circuit breaker per pile: after breakerThreshold failed cycles in a row a
+#pile is left alone for breakerCooldown secs (doubling up to
+#breakerCooldownMax), then gets one trial connection. A flaky node can't
+#keep the radio busy with retries
+#*************************************************************
+class CircuitOpen(Exception):
+    pass
+
+class CircuitBreaker(object):
+    def __init__(self):
+        self.piles = {} #MAC -> {"failures", "openUntil", "cooldown"}
+        self.lock = threading.Lock()
+
+    def allow(self, MAC):
+        with self.lock:
+            pile = self.piles.get(MAC)
+            return pile is None or pile["openUntil"] <= time.time()
+
+    def success(self, MAC):
+        with self.lock:
+            self.piles.pop(MAC, None)
+
+    def failure(self, MAC):
+        with self.lock:
+            pile = self.piles.setdefault(MAC, {"failures":0, "openUntil":0, "cooldown":0})
+            pile["failures"] += 1
+            if pile["failures"] >= breakerThreshold:
+                pile["cooldown"] = min(breakerCooldownMax, pile["cooldown"] * 2 or breakerCooldown)
+                pile["openUntil"] = time.time() + pile["cooldown"]
+                print "Pile %s failed %d times, leaving it alone for %d mins" % (MAC, pile["failures"], pile["cooldown"] // 60)
+                metrics.increment("circuit_open_total")
+
+circuitBreaker = CircuitBreaker()
+
+def readHandle(p, handle, name):
+    with metrics.timer("ble_read_seconds", characteristic=name):
+        return p.readCharacteristic(handle)
+
+def readCompostValues(session, MAC): #returns {characteristic name: number, or None if it couldn't be read}
+    handles = session.call("discovery", characteristicCache.getHandles, MAC)
+    values = dict((name, None) for name in allReadingsFields)
+    if allReadingsUUID in handles: #one read for every sensor value
+        try:
+            val = session.call("read", readHandle, handles[allReadingsUUID], "allReadings")
+            values.update(decodeReading(val))
+            return values
+        except Exception as e:
+            print "Reading all values from %s failed (%s), reading them one by one" % (MAC, e)
     for x in range(0, uuidCount):
-        uuidVal = validUUIDs[x][0]
+        name = validUUIDs[x][1]
+        if name not in values:
+            continue
         try:
-            ch = p.getCharacteristics(uuid=uuidVal)[0]
-            if (ch.supportsRead()):
-                val = binascii.b2a_hex(ch.read())
-                val = binascii.unhexlify(val)
-                val = str(val).strip()
-                val = int(val)
-                print validUUIDs[x][1]+ ": "  + str(val)
-
-                if validUUIDs[x][1] == "compostTempF":
-                    tempF = val
-                    tempC = (tempF - 32) * 5/9
-                elif validUUIDs[x][1] == "ambientTempF":
-                    ambientTempF = val
-                    ambientTempC = (ambientTempF - 32) * 5/9
-                    if ambientTempF <=ambientTempCold:
-                        ambientTemp = "low"
-                    else:
-                        ambientTemp = "high"
-                elif validUUIDs[x][1] == "compostMoisture":
-                    moisture = val
-                elif validUUIDs[x][1] == "methanePPM" :
-		            methane = val
-                elif validUUIDs[x][1] == "waterLevel" :
-		            waterLevel = val
-        finally:
-            print "Done"
-    persistSensorData(tempF, tempC, ambientTempF, ambientTempC, moisture, methane, waterLevel)
-    overallMsg, ventAngle, needWater = analyzeData(tempF, tempC, ambientTemp, moisture, methane, waterLevel)
-    print str(needWater) + " : Need Water?"
-    print str(ventAngle) + " : Vent Angle"	
-    if needWater == 1:
-        ch = p.getCharacteristics(uuid="0411dc98-895b-4639-b627-c663f6726c3c")[0]
-        ch.write("1")
-    if ventAngle == 1:
-        ch = p.getCharacteristics(uuid="0411dc97-895b-4639-b627-c663f6726c3c")[0]
-        ch.write("1")
-    else:
-        ch = p.getCharacteristics(uuid="0411dc97-895b-4639-b627-c663f6726c3c")[0]
-        ch.write("0")
-    p.disconnect()
+            val = session.call("read", readHandle, handles[validUUIDs[x][0]], name)
+            values[name] = int(str(val).strip())
+        except SessionCancelled:
+            raise
+        except Exception as e:
+            print "Reading %s from %s failed: %s" % (name, MAC, e)
+            metrics.increment("read_failures_total", characteristic=name)
+    return values
+
+def decodeReading(data): #allReadings value -> {field: value}, plus "sequence" and "sensorTime" from packed firmware
+    view = memoryview(data) #struct reads straight from the buffer, no slicing
+    version = ord(view[0]) if len(view) else 0
+    layout = packedReadingFormats.get(version)
+    if layout is not None:
+        fields = layout.unpack_from(view, 1)
+        values = dict((name, round(value * scale, 2) if scale != 1 else value) for name, value, scale in zip(allReadingsFields, fields[2:], packedReadingScales))
+        values["sequence"] = fields[0]
+        values["sensorTime"] = fields[1]
+        return values
+    if version < 0x20: #not ASCII either
+        raise ValueError("Unknown reading format %d" % version)
+    fields = view.tobytes().strip().split(",")
+    if len(fields) != len(allReadingsFields):
+        raise ValueError("Expected %d readings, got %d" % (len(allReadingsFields), len(fields)))
+    return dict(zip(allReadingsFields, [int(field) for field in fields]))
+
+#*************************************************************
+#On-sensor history: firmware with the packed format also buffers a reading
+#every few minutes while nobody is connected. After the live reading the
+#host asks for everything not acknowledged yet (write 0 to
+#historyControlUUID), gets it as one notification per reading and an end
+#record, stores it with the original times in one transaction and then
+#acknowledges the sequence, so the sensor drops those readings. Sequences
+#are contiguous from the end record's first to its latest: a notification
+#lost on the way leaves a gap, and only what comes before the first gap is
+#stored and acknowledged - the rest is sent again next time. The sequence
+#starts again when the sensor restarts, which the end record's boot ID tells.
+#The sensor clock may never have been set, so the times are shifted by the
+#difference between the host clock and the sensor clock at the end record
+#*************************************************************
+historyUUID = "0411dc9a-895b-4639-b627-c663f6726c3c" #notify - one packed reading per notification, then the end record
+historyControlUUID = "0411dc9b-895b-4639-b627-c663f6726c3c" #write uint32 - 0 = send the buffered readings, N = drop readings up to sequence N
+historyEnd = struct.Struct("<BIIII") #version 0, first and latest buffered sequence, sensor time now, boot ID
+historyWait = 5 #secs without a notification before the transfer is given up
+historyOverlap = 300 #secs - a buffered reading this close to a live one is the same sample, and isn't stored twice
+sensorHistoryTable = "CREATE TABLE IF NOT EXISTS sensorHistory (device TEXT PRIMARY KEY, lastSequence INTEGER, bootId INTEGER)"
+
+class HistoryCollector(object): #bluepy delegate for the transfer
+    def __init__(self, handle):
+        self.handle = handle
+        self.readings = []
+        self.end = None #(first sequence, latest sequence, sensor time, boot ID) once the end record arrives
+
+    def handleNotification(self, cHandle, data):
+        if cHandle != self.handle:
+            return
+        if ord(data[0]) == 0:
+            self.end = historyEnd.unpack_from(memoryview(data))[1:]
+        else:
+            self.readings.append(decodeReading(data))
+
+def transferHistory(p, handles):
+    collector = HistoryCollector(handles[historyUUID])
+    p.withDelegate(collector)
+    p.writeCharacteristic(handles[historyUUID] + 1, "\x01\x00") #client characteristic configuration, turns notifications on
+    p.writeCharacteristic(handles[historyControlUUID], struct.pack("<I", 0))
+    while collector.end is None:
+        if not p.waitForNotifications(historyWait):
+            raise Exception("History transfer stopped after %d readings" % len(collector.readings))
+    return collector
+
+def fetchHistory(session, MAC): #(boot ID, sequence, [(epoch, values), ...]) received without a gap up to sequence, or None for older firmware
+    handles = characteristicCache.getHandles(None, MAC) #cached by readCompostValues
+    if historyUUID not in handles or historyControlUUID not in handles:
+        return None
+    with metrics.timer("stage_seconds", stage="history"):
+        collector = session.call("history", transferHistory, handles)
+    first, latest, sensorNow, bootId = collector.end
+    clockOffset = time.time() - sensorNow
+    received = dict((values["sequence"], values) for values in collector.readings)
+    sequence = first - 1
+    while sequence + 1 in received:
+        sequence += 1
+    if sequence < latest:
+        print "%d of %d buffered readings reached us from %s, the rest are fetched next time" % (len(received), latest - first + 1, MAC)
+        metrics.increment("history_gaps_total")
+    elif received:
+        print "%d readings buffered on %s" % (len(received), MAC)
+    readings = [(int(received[s]["sensorTime"] + clockOffset), received[s]) for s in range(first, sequence + 1)]
+    return bootId, sequence, [reading for reading in readings if reading[0] < time.time() - historyOverlap] #the live reading was just taken
+
+def ackHistory(session, MAC, sequence): #after the readings are stored (or queued), the sensor can drop them
+    if not sequence: #0 would ask for the history again
+        return
+    handles = characteristicCache.getHandles(None, MAC)
+    try:
+        session.call("write", writeActuator, handles[historyControlUUID], struct.pack("<I", sequence))
+    except SessionCancelled:
+        raise
+    except Exception as e: #they come again next time and are skipped by persistHistory
+        print "Acknowledging the history on " + MAC + " failed: " + str(e)
+        metrics.increment("exceptions_total", where="history")
+
+def persistHistory(device, bootId, sequence, readings): #stores buffered readings at their own times, returns how many were new
+    rows = store.query("SELECT lastSequence, bootId FROM sensorHistory WHERE device = ?", (device,))
+    lastSequence = rows[0][0] if rows else 0
+    if not rows or rows[0][1] != bootId: #the sensor restarted, and its sequence with it
+        lastSequence = 0
+    epoch = getattr(cycleState, "epoch", None)
+    stored = 0
+    try:
+        with store.transaction():
+            for sampleEpoch, values in sorted(readings, key=lambda reading: reading[1]["sequence"]):
+                if values["sequence"] <= lastSequence: #stored last time, but the ack didn't get through
+                    continue
+                if store.query("SELECT 1 FROM readings WHERE device = ? AND datetime > ? AND datetime < ? LIMIT 1", (device, sampleEpoch - historyOverlap, sampleEpoch + historyOverlap)):
+                    continue #buffered while a live reading was taken
+                cycleState.epoch = sampleEpoch
+                persistSensorData(*readingRow(values), device=device)
+                stored += 1
+            store.execute("INSERT OR REPLACE INTO sensorHistory (device, lastSequence, bootId) values (?, ?, ?)", (device, max(lastSequence, sequence), bootId))
+    finally:
+        cycleState.epoch = epoch
+    if stored:
+        trendEstimators.pop(device, None) #earlier days changed, reload them from the rollup
+        metrics.increment("history_readings_total", stored)
+    return stored
+
+readingColumns = {"compostTempF":"tempF", "ambientTempF":"ambientTempF", "compostMoisture":"moisture", "methanePPM":"methane", "waterLevel":"waterLevel"}
+
+def lastValidValues(device, names): #latest stored value of each field, for fields missing from a partial reading
+    values = {}
+    for name in names:
+        rows = store.query("SELECT " + readingColumns[name] + " FROM readings WHERE device = ? AND " + readingColumns[name] + " IS NOT NULL ORDER BY datetime DESC LIMIT 1", (device,))
+        values[name] = rows[0][0] if rows else None
+    return values
+
+def readingRow(values): #(tempF, tempC, ambientTempF, ambientTempC, moisture, methane, waterLevel) for persistSensorData
+    tempF = values["compostTempF"]
+    ambientTempF = values["ambientTempF"]
+    return (tempF, None if tempF is None else (tempF - 32) * 5.0/9, ambientTempF, None if ambientTempF is None else (ambientTempF - 32) * 5.0/9,
+        values["compostMoisture"], values["methanePPM"], values["waterLevel"])
+
+def fieldMask(values): #bit x set if allReadingsFields[x] was read
+    return sum(1 << x for x, name in enumerate(allReadingsFields) if values[name] is not None)
+
+def processReading(device, values, epoch=None, history=None): #stores and analyzes one reading (history = buffered readings from fetchHistory), returns (message, ventAngle, needWater)
+    for name in allReadingsFields:
+        print name + ": " + str(values[name])
+
+    #partial readings are stored as they are, with a bit per valid field;
+    #the analysis fills the gaps with the pile's last stored values
+    missing = [name for name in allReadingsFields if values[name] is None]
+    analysisValues = dict((name, values[name]) for name in allReadingsFields)
+    if missing:
+        print "Partial reading from " + device + ", missing " + ", ".join(missing)
+        metrics.increment("partial_readings_total")
+        analysisValues.update(lastValidValues(device, missing))
+
+    with analysisCycle(epoch):
+        if history is not None: #older than this reading, stored first
+            persistHistory(device, *history)
+        persistSensorData(*readingRow(values), device=device, validFields=fieldMask(values))
+        if None in analysisValues.values(): #nothing to fall back on yet, no analysis and no actuators this time
+            return "Partial reading", None, None
+        tempF = analysisValues["compostTempF"]
+        tempC = (tempF - 32) * 5.0/9
+        if analysisValues["ambientTempF"] <=ambientTempCold:
+            ambientTemp = "low"
+        else:
+            ambientTemp = "high"
+        return analyzeData(tempF, tempC, ambientTemp, analysisValues["compostMoisture"], analysisValues["methanePPM"], analysisValues["waterLevel"], device)
+
+def writeActuator(p, handle, value):
+    p.writeCharacteristic(handle, value)
+
+@metrics.timed("stage_seconds", stage="cycle")
+def connectToDevice(MAC, device=defaultDevice):
+    if not circuitBreaker.allow(MAC):
+        raise CircuitOpen(MAC)
+    radioStart = time.time()
+    session = openSession(MAC)
+    try:
+        try:
+            with metrics.timer("stage_seconds", stage="read"):
+                values = readCompostValues(session, MAC)
+            if not [v for v in values.values() if v is not None]:
+                raise Exception("No values could be read")
+        except:
+            characteristicCache.forget(MAC)
+            circuitBreaker.failure(MAC)
+            raise
+        circuitBreaker.success(MAC)
+
+        history = None
+        if "sequence" in values: #packed firmware buffers readings while the pile is out of reach
+            try:
+                history = fetchHistory(session, MAC)
+            except SessionCancelled:
+                raise
+            except Exception as e: #still there next time, the sensor only drops what is acknowledged
+                print "Fetching the history from " + MAC + " failed: " + str(e)
+                metrics.increment("exceptions_total", where="history")
+
+        if sampleLog is not None: #split processes: the analyzer stores and analyzes it, and sends back the vent and pump
+            if history is not None:
+                sampleLog.append({"kind":"history", "device":device, "bootId":history[0], "sequence":history[1], "readings":history[2]})
+            offset = sampleLog.append({"kind":"reading", "device":device, "datetime":time.time(), "values":values})
+            if history is not None:
+                sampleLog.sync() #on disk before the sensor drops it
+                ackHistory(session, MAC, history[1])
+            overallMsg = "Queued"
+            command = commandBoard.wait(device, offset, commandWait)
+            ventAngle, needWater = (command["ventAngle"], command["needWater"]) if command else (None, None)
+        else:
+            overallMsg, ventAngle, needWater = processReading(device, values, history=history)
+            if history is not None:
+                ackHistory(session, MAC, history[1])
+        if ventAngle is None: #partial reading with nothing to fall back on, or no word from the analyzer yet
+            return overallMsg
+        print str(needWater) + " : Need Water?"
+        print str(ventAngle) + " : Vent Angle"	
+        handles = characteristicCache.getHandles(None, MAC) #cached by readCompostValues
+        try:
+            if needWater == 1:
+                session.call("write", writeActuator, handles[startPumpUUID], "1")
+            if ventAngle == 1:
+                session.call("write", writeActuator, handles[ventAngleUUID], "1")
+            else:
+                session.call("write", writeActuator, handles[ventAngleUUID], "0")
+        except SessionCancelled:
+            raise
+        except Exception as e: #the reading is stored, the actuators get another chance next cycle
+            print "Setting the pump and vent on " + MAC + " failed: " + str(e)
+            metrics.increment("exceptions_total", where="actuators")
+    finally:
+        releaseSession(session, device)
+        pollPlanner.useRadio(time.time() - radioStart)
     return overallMsg
 
 
-def getMAC(valueName):
-    scanner = Scanner().withDelegate(ScanDelegate())
-    devices = scanner.scan(4.0)
+def getMAC(valueName, wait=discoveryWait): #device with the name and the best signal
+    MACs = getMACs(valueName, wait)
+    if MACs:
+        return MACs[0]
+    return "empty"
+
+def getMACs(valueName, wait=discoveryWait): #every device found with the name, best signal first
+    if not discoveryScanner.isRunning(): #no background scanner (tools, one-off runs), scan now
+        discoveryScanner.scanOnce()
+        wait = 0
+    MACs = discoveryCache.lookupAll(valueName, wait)
+    if not MACs:
+        metrics.increment("scan_misses_total", device=valueName)
+    for MAC in MACs:
+        entry = discoveryCache.entry(valueName, MAC)
+        if entry:
+            print "Device %s (%s), RSSI=%d dB" % (MAC, entry["addrType"], entry["rssi"])		
+            print "  %s = %s" % ("Complete Local Name", valueName)
+    return MACs
 
-    MAC = "empty"
-			
-    for dev in devices:
-        for (adtype, desc, value) in dev.getScanData():
-            if (desc == "Complete Local Name" and value == valueName):
-                print "Device %s (%s), RSSI=%d dB" % (dev.addr, dev.addrType, dev.rssi)		
-                print "  %s = %s" % (desc, value)
-                MAC = dev.addr
-    return MAC
-
-				
-    
-	
 #*************************************************************
-#Code that starts the process
-# 1 - Scan devices and determine if Kitchen Bin system is available
-# 2  If device is available, registers for notifications
-# 3 - Scan devices and determine if Compost system is available
-# 4a - If available, reads sensor data, saves to database
-# 4b - performs analysis and writes json file for UI
-# 5 - waits an hour and reconnects.
-#
-# If a system cannot be found, attepts again in 5 mins
-#************************************************************* 
+#Fleet mode: reads every pile with a bounded pool of worker threads.
+#BLE reads run in parallel; persisting and analysis take the store lock so
+#they run one pile at a time. Each pile is namespaced by its MAC
+#*************************************************************
+activeSessions = {} #MAC -> PileSession being read
+
+def pollFleet(MACs=None): #every pile by default
+    MACs = MACs or list(fleetMACs) or getMACs(deviceNameCompost)
+    if not MACs:
+        return {}
+
+    jobs = Queue.Queue()
+    done = Queue.Queue()
+    started = {}
+    for MAC in MACs:
+        jobs.put(MAC)
 
+    def worker():
+        while True:
+            try:
+                MAC = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            started[MAC] = time.time()
+            try:
+                done.put((MAC, connectToDevice(MAC, MAC)))
+            except Exception as e:
+                metrics.increment("exceptions_total", where="pollFleet")
+                done.put((MAC, e))
+
+    def startWorker():
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+
+    for x in range(0, min(fleetWorkers, len(MACs))):
+        startWorker()
+
+    results = {}
+    while len(results) < len(MACs):
+        try:
+            MAC, result = done.get(timeout=1.0)
+            if MAC not in results:
+                results[MAC] = result
+        except Queue.Empty:
+            pass
+        for MAC, startTime in started.items():
+            if MAC not in results and time.time() - startTime > fleetDeviceTimeout:
+                print "Pile " + MAC + " timed out"
+                metrics.increment("timeouts_total")
+                results[MAC] = "timeout"
+                circuitBreaker.failure(MAC)
+                session = activeSessions.get(MAC)
+                if session is not None:
+                    session.cancel() #unblocks the stuck worker and stops its retries
+                startWorker() #the stuck worker no longer counts against the pool
+    for MAC in MACs:
+        print MAC + ": " + str(results[MAC])
+    uiPublisher.flush() #once for the round
+    return results
 
-#Enable bluetooth
-print "Turning on Bluetooth"
-os.system("rfkill unblock bluetooth")
-time.sleep(3)
+#*************************************************************
+#Scheduler: a small event loop (Python 2 has no asyncio). Timers sit in a
+#heap, blocking BLE work runs on executor threads and its result comes
+#back through the event queue, so the loop sleeps until the next timer or
+#event instead of polling
+#*************************************************************
+class Scheduler(object):
+    def __init__(self):
+        self.timers = [] #(when, sequence, function, args)
+        self.events = Queue.Queue()
+        self.sequence = itertools.count()
+        self.running = False
 
-nowSecs = 0
-nowKitchenSecs = 0
-connectedToKitchen = False
+    def callLater(self, delay, function, *args): #only from the loop thread
+        heapq.heappush(self.timers, (time.time() + delay, next(self.sequence), function, args))
 
-kitchenMAC= "empty"
-kitchenMAC = getMAC("KitchenBin")
-kitchenPConnected = False
+    def callSoon(self, function, *args): #safe from any thread
+        self.events.put((function, args))
 
-if kitchenMAC != "empty":
-    kitchenP = Peripheral(kitchenMAC)
+    def runInExecutor(self, function, args, callback): #callback(result, error) runs on the loop thread
+        def run():
+            try:
+                self.callSoon(callback, function(*args), None)
+            except Exception as e:
+                self.callSoon(callback, None, e)
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+
+    def dispatch(self, function, args):
+        try:
+            function(*args)
+        except Exception as e:
+            print "Scheduled task " + function.__name__ + " failed: " + str(e)
+            metrics.increment("exceptions_total", where=function.__name__)
+
+    def run(self):
+        self.running = True
+        while self.running:
+            timeout = 60 #wake up now and then so Ctrl-C gets through
+            if self.timers:
+                timeout = min(timeout, max(0, self.timers[0][0] - time.time()))
+            try:
+                function, args = self.events.get(timeout=timeout)
+                self.dispatch(function, args)
+            except Queue.Empty:
+                pass
+            while self.timers and self.timers[0][0] <= time.time():
+                when, sequence, function, args = heapq.heappop(self.timers)
+                self.dispatch(function, args)
+
+    def stop(self):
+        self.running = False
+
+scheduler = Scheduler()
+
+#*************************************************************
+#Adaptive polling: each pile's next poll comes from its last analysis.
+#A pile in danger is read every pollIntervalMin secs, a pile with a
+#warning at least every pollIntervalWarning secs, a pile whose temperature
+#trend is heading for a limit well before it gets there, and a steady or
+#cured pile rarely. Missed piles back off exponentially. BLE connections
+#may take radioBudget of the time; when that is spent only piles in danger
+#are read until older connections leave the window
+#*************************************************************
+def pollInterval(tempF, result, tempTrend, days, limits=None): #secs until the pile should be read again
+    if DANGER in (result["tempAlert"], result["methaneAlert"]) or result["msgPriority"] == 1:
+        return pollIntervalMin
+    interval = sleepIfFound
+    if days >= daysWhenReady: #cured, not much changes any more
+        interval = pollIntervalMax
+    if tempTrend: #how long until the trend reaches the next limit
+        limits = limits or rulesFor().limits
+        edges = [limits["tempDanger"], limits["tempHigh"], limits["tempOK"], limits["tempLow"]]
+        if tempTrend > 0:
+            ahead = [limit - tempF for limit in edges if limit > tempF]
+        else:
+            ahead = [tempF - limit for limit in edges if limit < tempF]
+        if ahead:
+            secsToLimit = min(ahead) / abs(tempTrend) * 86400
+            interval = min(interval, secsToLimit * pollLeadFraction)
+    if WARNING in (result["tempAlert"], result["moistAlert"], result["methaneAlert"]):
+        interval = min(interval, pollIntervalWarning)
+    return int(max(pollIntervalMin, min(pollIntervalMax, interval)))
+
+class PollPlanner(object):
+    def __init__(self):
+        self.piles = {} #device -> {"nextPoll", "interval", "urgent", "misses"}
+        self.scanMisses = 0 #polls in a row that found no pile at all
+        self.radio = collections.deque() #(end time, secs) of recent connections
+        self.lock = threading.Lock()
+
+    def pile(self, device):
+        return self.piles.setdefault(device, {"nextPoll":0, "interval":sleepIfFound, "urgent":False, "misses":0})
+
+    def analyzed(self, device, interval, urgent): #from analyzeData
+        with self.lock:
+            pile = self.pile(device)
+            pile["interval"] = interval
+            pile["urgent"] = urgent
+        metrics.setGauge("poll_interval_seconds", interval, device=device)
+
+    def polled(self, device):
+        with self.lock:
+            self.scanMisses = 0
+            pile = self.pile(device)
+            pile["misses"] = 0
+            pile["nextPoll"] = time.time() + pile["interval"]
+
+    def missed(self, device=None): #a pile that couldn't be read, or no pile found at all
+        with self.lock:
+            if device is None:
+                self.scanMisses += 1
+                return
+            pile = self.pile(device)
+            pile["misses"] += 1
+            pile["nextPoll"] = time.time() + self.backoff(pile["misses"])
+
+    def backoff(self, misses):
+        return min(pollBackoffMax, sleepIfNotFound * 2 ** min(misses - 1, 16))
+
+    def useRadio(self, secs):
+        with self.lock:
+            self.radio.append((time.time(), secs))
+
+    def radioLeft(self, now): #secs of connections left in the budget
+        oldest = now - radioBudgetWindow
+        while self.radio and self.radio[0][0] < oldest:
+            self.radio.popleft()
+        return radioBudget * radioBudgetWindow - sum(secs for end, secs in self.radio)
+
+    def due(self, devices): #the piles to read now, piles in danger first
+        now = time.time()
+        with self.lock:
+            budget = self.radioLeft(now)
+            due = [d for d in devices if self.pile(d)["nextPoll"] <= now]
+            due.sort(key=lambda d: (not self.piles[d]["urgent"], self.piles[d]["nextPoll"]))
+            if budget <= 0:
+                deferred = len([d for d in due if not self.piles[d]["urgent"]])
+                if deferred:
+                    print "Radio budget spent, %d piles wait" % deferred
+                    metrics.increment("polls_deferred_total", deferred)
+                due = [d for d in due if self.piles[d]["urgent"]]
+            return due
+
+    def nextWake(self): #secs until the next pile is due
+        now = time.time()
+        with self.lock:
+            if not self.piles or self.scanMisses:
+                return self.backoff(max(1, self.scanMisses))
+            budgetFree = now
+            if self.radioLeft(now) <= 0:
+                budgetFree = self.radio[0][0] + radioBudgetWindow #when the oldest connection leaves the window
+            wake = min(pile["nextPoll"] if pile["urgent"] else max(pile["nextPoll"], budgetFree) for pile in self.piles.values()) - now
+            return max(1, wake)
+
+pollPlanner = PollPlanner()
+
+#*************************************************************
+#Scheduled tasks
+# KitchenBin - scan, connect, then a listener thread waits for
+#   notifications and hands each level to the loop. Rescans every
+#   sleepIfNotFound secs while the bin can't be found or drops off
+# Compost - scan and read the pile (or the fleet) on an executor thread,
+#   then wait sleepIfFound or sleepIfNotFound secs for the next poll
+# Retention - compacts old readings every compactionInterval secs
+#*************************************************************
+def scanKitchenBin():
+    scheduler.runInExecutor(getMAC, ("KitchenBin",), kitchenBinScanned)
+
+def kitchenBinScanned(kitchenMAC, error):
+    if error is None and kitchenMAC != "empty":
+        scheduler.runInExecutor(connectKitchenBin, (kitchenMAC,), kitchenBinConnected)
+    else:
+        print "KitchenBin not found, need to look again in 5 mins"
+        metrics.increment("retries_total", task="scanKitchenBin")
+        scheduler.callLater(sleepIfNotFound, scanKitchenBin)
+
+def connectKitchenBin(kitchenMAC):
+    with discoveryScanner.paused():
+        kitchenP = ble().Peripheral(kitchenMAC)
     kitchenP.setDelegate( MyDelegate() )
-	# Setup to turn notifications on, e.g.
+    # Setup to turn notifications on, e.g.
     svc = kitchenP.getServiceByUUID('9a4587b1-4d85-4c75-b88b-faa619295a18')
     ch = svc.getCharacteristics()[0]
     print(ch.valHandle)
 
     kitchenP.writeCharacteristic(ch.valHandle+1, "\x01\x00")
-    kitchenPConnected = True
+    return kitchenP
 
+def kitchenBinConnected(kitchenP, error):
+    if error is not None:
+        print "Could not connect to KitchenBin: " + str(error)
+        metrics.increment("exceptions_total", where="connectKitchenBin")
+        metrics.increment("retries_total", task="scanKitchenBin")
+        scheduler.callLater(sleepIfNotFound, scanKitchenBin)
+        return
     print("connected to KitchenBin and waiting for notifications")
+    t = threading.Thread(target=listenToKitchenBin, args=(kitchenP,))
+    t.daemon = True
+    t.start()
 
-while 1:
-    
-    if kitchenPConnected == True:
-        if kitchenP.waitForNotifications(1.0):
-            continue
-    else:
-        while nowKitchenSecs < time.time():
-            kitchenMAC = getMAC("KitchenBin")
-            if kitchenMAC != "empty":
-                kitchenP = btle.Peripheral(kitchenMAC)
-                kitchenP.setDelegate( MyDelegate() )
-                kitchenPConnected = true
-
-                print("connected to KitchenBin and waiting for notifications")
+def listenToKitchenBin(kitchenP): #runs on its own thread, notifications go through MyDelegate
+    try:
+        while True:
+            kitchenP.waitForNotifications(1.0)
+    except Exception as e:
+        print "Lost KitchenBin: " + str(e)
+        metrics.increment("exceptions_total", where="listenToKitchenBin")
+        metrics.increment("retries_total", task="scanKitchenBin")
+        scheduler.callSoon(scheduler.callLater, sleepIfNotFound, scanKitchenBin)
+
+def pollCompost():
+    scheduler.runInExecutor(readCompost, (), compostPolled)
+
+def readCompost(): #reads the piles that are due, returns how many were read (None if none were due)
+    if fleetMode:
+        MACs = list(fleetMACs) or getMACs(deviceNameCompost)
+        if not MACs:
+            pollPlanner.missed()
+            return 0
+        for device in pollPlanner.due(pollPlanner.piles.keys()):
+            if device not in MACs: #due, but not seen by the scanner
+                pollPlanner.missed(device)
+        due = pollPlanner.due(MACs)
+        if not due:
+            return None
+        read = 0
+        for MAC, result in pollFleet(due).items():
+            if isinstance(result, basestring) and result != "timeout":
+                pollPlanner.polled(MAC)
+                read += 1
             else:
-                nowKitchenSecs = time.time() + sleepIfNotFound
-	
-    while nowSecs < time.time():
-        MAC = getMAC("Compost")		
-		
-        if (MAC != "empty"):
-            print "found it"
-            try:
-                print connectToDevice(MAC)
-                nowSecs = time.time() + sleepIfFound
-                MAC = "empty"	
-                print "We got the readings, wait for an hour"
-            except:
-                MAC = "empty"		
+                pollPlanner.missed(MAC)
+        return read
+    if not pollPlanner.due([defaultDevice]): #radio budget spent
+        return None
+    MAC = getMAC("Compost")
+    if MAC == "empty":
+        pollPlanner.missed()
+        return 0
+    print "found it"
+    try:
+        print connectToDevice(MAC)
+    except:
+        pollPlanner.missed(defaultDevice)
+        raise
+    finally:
+        uiPublisher.flush()
+    pollPlanner.polled(defaultDevice)
+    return 1
+
+def compactReadingsTask():
+    try:
+        if exportFolder: #before compaction deletes the raw rows
+            import historyExport
+            if not os.path.isdir(exportFolder):
+                os.makedirs(exportFolder)
+            print "Exported %d readings" % historyExport.exportReadings(store.path, exportFolder)
+        compactReadings()
+    finally:
+        scheduler.callLater(compactionInterval, compactReadingsTask)
+
+def compostPolled(read, error):
+    if error is not None:
+        print "Reading the compost failed: " + str(error)
+        metrics.increment("exceptions_total", where="readCompost")
+    wait = pollPlanner.nextWake()
+    if read:
+        print "We got the readings, next poll in %d mins" % (wait // 60)
+        metrics.setGauge("last_poll_timestamp_seconds", int(time.time()))
+    elif read is None:
+        print "No pile due, next poll in %d mins" % (wait // 60)
+    else:
+        print "Nothing read, look again in %d mins" % (wait // 60)
+        metrics.increment("retries_total", task="pollCompost")
+    scheduler.callLater(wait, pollCompost)
+    if sampleLog is None: #ingest leaves the database to the analyzer
+        updateDatabaseGauges()
+
+metricsTables = ["readings", "readingsDownsampled", "dailyReadings", "ui", "kitchenScraps", "scrapEvents"]
+lastTableCount = 0 #when the table_rows gauges were last counted
+
+def updateDatabaseGauges(): #runs after each poll, so /metrics never waits on the store lock
+    global lastTableCount
+    size = 0
+    for suffix in ["", "-wal"]:
+        if os.path.exists(store.path + suffix):
+            size += os.path.getsize(store.path + suffix)
+    metrics.setGauge("database_bytes", size)
+    if time.time() - lastTableCount >= tableRowsInterval: #count(*) grows with the history, so not after every poll
+        lastTableCount = time.time()
+        for table in metricsTables:
+            metrics.setGauge("table_rows", store.query("SELECT count(*) FROM " + table)[0][0], table=table)
+    if metricsFile:
+        writeFileAtomically(metricsFile, metrics.render())
+
+#*************************************************************
+#Split processes: ingest only talks BLE and appends each raw sample to
+#queue/samples; the analyzer reads the queue in batches and stores,
+#analyzes and publishes the samples on its own core. The analyzer's queue
+#offset is committed in the same transaction as its batch (with any
+#buffered KitchenBin levels), so after a crash of either process every
+#sample is stored exactly once. Vent, pump and each pile's next poll
+#interval go back to ingest through queue/commands
+#*************************************************************
+queueOffsetsTable = "CREATE TABLE IF NOT EXISTS queueOffsets (name TEXT PRIMARY KEY, offset INTEGER)"
+sampleLog = None #sampleQueue.QueueWriter for queue/samples, set in the ingest process
+commandBoard = None #CommandBoard for queue/commands, set in the ingest process
+commandLog = None #sampleQueue.QueueWriter for queue/commands, set in the analyzer process
+analyzerProcess = None
+
+class CommandBoard(object): #the analyzer's replies, read by ingest
+    def __init__(self, folder):
+        self.reader = sampleQueue.QueueReader(folder)
+        self.offsetFile = folder + ".offset"
+        self.offset = sampleQueue.loadOffset(self.offsetFile)
+        self.commands = {} #device -> {"sample", "ventAngle", "needWater", "interval", "urgent"}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        with self.lock:
+            records = self.reader.read(self.offset, 1000)
+            for self.offset, command in records:
+                self.commands[command["device"]] = command
+                pollPlanner.analyzed(command["device"], command["interval"], command["urgent"])
+            if records:
+                sampleQueue.saveOffset(self.offsetFile, self.offset)
+                self.reader.discard(self.offset)
+
+    def wait(self, device, sample, timeout): #the command for the sample queued at offset sample, or None
+        deadline = time.time() + timeout
+        while True:
+            self.refresh()
+            command = self.commands.get(device)
+            if command is not None and command["sample"] >= sample:
+                return command
+            if time.time() >= deadline: #a stale command could start the pump twice
+                return None
+            time.sleep(0.1)
+
+def loadQueueOffset(name):
+    rows = store.query("SELECT offset FROM queueOffsets WHERE name = ?", (name,))
+    return rows[0][0] if rows else 0
+
+def analyzeSample(offset, sample): #returns the command for ingest, or None
+    if sample["kind"] == "history":
+        persistHistory(sample["device"], sample["bootId"], sample["sequence"], sample["readings"])
+        return None
+    if sample["kind"] == "scrap":
+        cycleState.epoch = sample["datetime"]
+        try:
+            scrapBuffer.add(sample["level"])
+        finally:
+            cycleState.epoch = None
+        return None
+    overallMsg, ventAngle, needWater = processReading(sample["device"], sample["values"], sample["datetime"])
+    print overallMsg
+    pile = pollPlanner.pile(sample["device"])
+    return {"device":sample["device"], "sample":offset, "ventAngle":ventAngle, "needWater":needWater, "interval":pile["interval"], "urgent":pile["urgent"]}
+
+def analyzeQueue(): #the next batch of samples, on the analyzer's loop
+    batch = []
+    try:
+        reader = sampleQueue.QueueReader(os.path.join(queueFolder, "samples"))
+        batch = reader.read(loadQueueOffset("samples"), analyzerBatchSize)
+        if not batch:
+            return
+        commands = []
+        with store.transaction() as conn: #one commit for the batch and its offset
+            for offset, sample in batch:
+                conn.execute("SAVEPOINT sample")
+                try:
+                    command = analyzeSample(offset, sample)
+                except Exception as e: #a sample that can't be analyzed mustn't hold up the queue
+                    conn.execute("ROLLBACK TO sample")
+                    print "Analyzing a sample failed: " + str(e)
+                    metrics.increment("exceptions_total", where="analyzeSample")
+                    command = None
+                conn.execute("RELEASE sample")
+                if command is not None:
+                    commands.append(command)
+            scrapBuffer.flush() #buffered levels are only safe once saved, and this commit is happening anyway
+            conn.execute("INSERT OR REPLACE INTO queueOffsets (name, offset) values (?, ?)", ("samples", batch[-1][0]))
+        for command in commands:
+            commandLog.append(command)
+        uiPublisher.flush() #the batch is committed; after the commands, ingest is waiting for those
+        if reader.discardable(batch[-1][0]):
+            #synchronous=NORMAL doesn't fsync the commit, so after a power loss the offset could roll back
+            #to a segment already deleted; a full checkpoint makes it durable before anything goes
+            busy, frames, copied = store.query("PRAGMA wal_checkpoint(FULL)")[0]
+            if not busy and frames == copied:
+                reader.discard(batch[-1][0])
+        metrics.increment("queue_samples_total", len(batch))
+    finally:
+        scheduler.callLater(0 if len(batch) == analyzerBatchSize else analyzerPollInterval, analyzeQueue)
+
+def runAnalyzer(): #python getReadings.py analyzer
+    global commandLog
+    commandLog = sampleQueue.QueueWriter(os.path.join(queueFolder, "commands"))
+    if uiServerPort:
+        dashboardServer.start()
+    scheduler.callSoon(analyzeQueue)
+    scheduler.callLater(60, compactReadingsTask)
+    try:
+        scheduler.run()
+    finally:
+        scrapBuffer.flush()
+
+def startIngest(startAnalyzer): #python getReadings.py ingest runs without starting the analyzer (e.g. its own service)
+    global sampleLog, commandBoard, analyzerProcess
+    sampleLog = sampleQueue.QueueWriter(os.path.join(queueFolder, "samples"))
+    commandBoard = CommandBoard(os.path.join(queueFolder, "commands"))
+    if ingestMetricsPort:
+        ingestMetricsServer.start()
+    if startAnalyzer:
+        analyzerProcess = subprocess.Popen([sys.executable, os.path.abspath(__file__), "analyzer"])
+
+#*************************************************************
+#Code that starts the process
+# 1 - Scan devices and determine if Kitchen Bin system is available
+# 2  If device is available, registers for notifications
+# 3 - Scan devices and determine if Compost system is available
+# 4a - If available, reads sensor data, saves to database
+# 4b - performs analysis and writes json file for UI
+# 5 - waits an hour and reconnects.
+#
+# If a system cannot be found, attepts again in 5 mins
+#************************************************************* 
+def main():
+    command = None
+    if len(sys.argv) > 1:
+        command = sys.argv[1]
+
+    ingest = command == "ingest" or (splitProcesses and command is None)
+    if not ingest: #ingest only queues samples, the analyzer owns the database
+        initDatabase()
+
+    if command == "rebuild-daily":
+        rebuildDailyReadings()
+        return
+    elif command == "compact":
+        compactReadings()
+        return
+    elif command == "archive-pile": #python getReadings.py archive-pile <device>
+        archivePile(sys.argv[2])
+        return
+    elif command == "new-pile": #python getReadings.py new-pile [device] [--archive]
+        args = [arg for arg in sys.argv[2:] if arg != "--archive"]
+        startNewPile(args[0] if args else defaultDevice, "--archive" in sys.argv)
+        return
+    elif command == "scrap-report": #python getReadings.py scrap-report [weeks]
+        weeks = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+        end = time.time()
+        start = end - weeks * 7 * 86400
+        for row in getScrapsAdded(start, end):
+            print "Week %s: %.2f lbs, emptied %d times" % (row["period"], row["lbsAdded"], row["emptied"])
+        for row in getFillRate(start, end):
+            print "%s: filled %d cm (%.2f lbs)" % (row["day"], row["cmAdded"], row["lbsAdded"])
+        return
+    elif command == "analyzer": #stores and analyzes what the ingest process queues
+        runAnalyzer()
+        return
+
+    if ingest: #the analyzer serves the dashboard and compacts the database
+        startIngest(command != "ingest")
+    elif uiServerPort: #the last readings are served right away, before the radio is up
+        dashboardServer.start()
+
+    #Enable bluetooth - no need to wait for the adapter, the scanner retries until it is up
+    print "Turning on Bluetooth"
+    os.system("rfkill unblock bluetooth")
+
+    discoveryScanner.start()
+    scheduler.callSoon(scanKitchenBin)
+    scheduler.callSoon(pollCompost)
+    if not ingest:
+        scheduler.callLater(60, compactReadingsTask) #not in the way of the first poll after a reboot
+    try:
+        scheduler.run()
+    finally:
+        if ingest:
+            sampleLog.sync()
+            if analyzerProcess is not None:
+                analyzerProcess.terminate()
         else:
-            print "We didn't find, need to look again in 5 mins"
-            nowSecs = time.time() + sleepIfNotFound
-		
-		
+            scrapBuffer.flush() #don't lose the levels from the last few minutes
 
+if __name__ == "__main__":
+    main()
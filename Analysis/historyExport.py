@@ -0,0 +1,163 @@
+##################################################################
+#historyExport.py is part of the Smart Compost system
+#Exports the readings table to fixed-width column files, one folder per
+#pile and month:
+#   <folder>/<pile>/<YYYY-MM>/<column>.npy
+#Each column is a NumPy .npy file (float64 datetime, float32 values, NaN
+#where a value is missing), so the data team can memory-map years of
+#history with numpy.load(path, mmap_mode='r') instead of querying the
+#live database. Exports are incremental: export.json remembers the last
+#exported row and the rows in each partition, so a rerun only appends new
+#rows and an interrupted export is rolled back to the last checkpoint.
+#Writing needs no numpy, loading does.
+#
+#Usage: python historyExport.py [--full] [database] [folder]
+#######
+#Questions: @darianbjohnson (Twitter) or darianbjohnson.com
+##################################################################
+
+import array
+import io
+import json
+import os
+import sqlite3
+import sys
+from datetime import datetime
+
+columns = [("datetime", "<f8", "d"), ("tempF", "<f4", "f"), ("tempC", "<f4", "f"), ("ambientTempF", "<f4", "f"), ("ambientTempC", "<f4", "f"),
+    ("moisture", "<f4", "f"), ("methane", "<f4", "f"), ("waterLevel", "<f4", "f")] #(name, .npy dtype, array typecode)
+headerSize = 128 #bytes - room to rewrite the row count in place as rows are appended
+chunkSize = 10000 #rows read from the database per query
+checkpointName = "export.json"
+
+#*************************************************************
+#.npy column files with a fixed size header, so they can be appended to
+#*************************************************************
+def npyHeader(dtype, rows):
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (dtype, rows)
+    header = header.ljust(headerSize - 10 - 1) + "\n"
+    return "\x93NUMPY\x01\x00" + chr(len(header) & 0xff) + chr(len(header) >> 8) + header
+
+class ColumnFile(object):
+    def __init__(self, path, dtype, typecode, rows): #rows = rows the checkpoint says the file holds
+        self.path = path
+        self.dtype = dtype
+        self.typecode = typecode
+        self.rows = rows
+        self.itemSize = array.array(typecode).itemsize
+        self.f = io.open(path, "r+b" if os.path.exists(path) else "w+b")
+        self.f.truncate(headerSize + rows * self.itemSize) #drops rows from an interrupted export
+        self.f.seek(0, os.SEEK_END)
+
+    def append(self, values):
+        data = array.array(self.typecode, values)
+        if sys.byteorder == "big":
+            data.byteswap()
+        self.f.write(data.tostring())
+        self.rows += len(values)
+
+    def close(self):
+        self.f.seek(0)
+        self.f.write(npyHeader(self.dtype, self.rows))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+
+#*************************************************************
+#Function to export readings added since the last export
+#*************************************************************
+def partitionFolder(device, epoch):
+    return os.path.join(device.replace(":", ""), datetime.fromtimestamp(epoch).strftime("%Y-%m"))
+
+def loadCheckpoint(folder):
+    path = os.path.join(folder, checkpointName)
+    if os.path.exists(path):
+        with io.open(path, "rb") as f:
+            return json.loads(f.read())
+    return {"lastRowid":0, "partitions":{}}
+
+def saveCheckpoint(folder, checkpoint):
+    path = os.path.join(folder, checkpointName)
+    with io.open(path + ".tmp", "wb") as f:
+        f.write(json.dumps(checkpoint, sort_keys=True))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + ".tmp", path)
+
+def exportReadings(database, folder, full=False): #returns the number of rows exported
+    if full and os.path.exists(os.path.join(folder, checkpointName)):
+        os.remove(os.path.join(folder, checkpointName)) #partitions are truncated to 0 rows as they are opened
+    checkpoint = loadCheckpoint(folder)
+    partitions = checkpoint["partitions"] #partition folder -> rows
+    files = {} #partition folder -> [ColumnFile, ...]
+    nan = float("nan")
+    conn = sqlite3.connect(database) #its own connection; with WAL the live process keeps writing meanwhile
+    exported = 0
+    try:
+        deviceColumn = "device"
+        if "device" not in [row[1] for row in conn.execute("PRAGMA table_info(readings)")]:
+            deviceColumn = "'default'" #database from before fleet mode, every reading is the default pile's
+        while True:
+            #short queries by rowid, so no read transaction is held for the whole export; readings.id
+            #is AUTOINCREMENT (getReadings.migrateReadingIds), so rows added after archiving a pile still sort after the checkpoint
+            rows = conn.execute("SELECT rowid, " + deviceColumn + ", " + ", ".join(name for name, dtype, typecode in columns) + " FROM readings WHERE rowid > ? ORDER BY rowid LIMIT ?", (checkpoint["lastRowid"], chunkSize)).fetchall()
+            if not rows:
+                break
+            byPartition = {}
+            for row in rows:
+                byPartition.setdefault(partitionFolder(row[1], row[2]), []).append(row[2:])
+            for partition, partitionRows in byPartition.items():
+                if partition not in files:
+                    path = os.path.join(folder, partition)
+                    if not os.path.isdir(path):
+                        os.makedirs(path)
+                    files[partition] = [ColumnFile(os.path.join(path, name + ".npy"), dtype, typecode, partitions.get(partition, 0)) for name, dtype, typecode in columns]
+                for x, column in enumerate(files[partition]):
+                    column.append([nan if row[x] is None else row[x] for row in partitionRows])
+            checkpoint["lastRowid"] = rows[-1][0]
+            exported += len(rows)
+    finally:
+        conn.close()
+        for partition, partitionFiles in files.items():
+            for column in partitionFiles:
+                column.close()
+    if exported:
+        for partition, partitionFiles in files.items():
+            partitions[partition] = partitionFiles[0].rows
+        saveCheckpoint(folder, checkpoint)
+    return exported
+
+#*************************************************************
+#Loaders: every column memory-mapped, nothing is copied until it is used
+#*************************************************************
+def listPartitions(folder): #{pile: [month, ...]} that have been exported
+    checkpoint = loadCheckpoint(folder)
+    piles = {}
+    for partition in checkpoint["partitions"]:
+        pile, month = os.path.split(partition)
+        piles.setdefault(pile, []).append(month)
+    for months in piles.values():
+        months.sort()
+    return piles
+
+def loadPartition(folder, pile, month): #{column: read-only numpy array} for one pile and month
+    import numpy as np
+    rows = loadCheckpoint(folder)["partitions"].get(os.path.join(pile.replace(":", ""), month), 0)
+    path = os.path.join(folder, pile.replace(":", ""), month)
+    return dict((name, np.load(os.path.join(path, name + ".npy"), mmap_mode="r")[:rows]) for name, dtype, typecode in columns)
+
+def loadPile(folder, pile): #[(month, {column: array}), ...] oldest month first
+    return [(month, loadPartition(folder, pile, month)) for month in listPartitions(folder).get(pile.replace(":", ""), [])]
+
+def main():
+    args = sys.argv[1:]
+    full = "--full" in args
+    args = [arg for arg in args if arg != "--full"]
+    database = args[0] if len(args) > 0 else "smart_compost.db"
+    folder = args[1] if len(args) > 1 else "export"
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    print "Exported %d readings to %s" % (exportReadings(database, folder, full), folder)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+##################################################################
+#metrics.py is part of the Smart Compost system
+#Counters, gauges and timers for the analysis process, rendered in the
+#Prometheus text format (served at /metrics by uiServer, or written to a
+#file for node_exporter's textfile collector). Timers are histograms, so
+#the slow stage of a cycle shows up in its buckets instead of being guessed
+#######
+#Questions: @darianbjohnson (Twitter) or darianbjohnson.com
+##################################################################
+
+import bisect
+import contextlib
+import functools
+import threading
+import time
+
+defaultBuckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0) #secs
+
+def labelKey(labels):
+    return tuple(sorted(labels.items()))
+
+def formatLabels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in pairs) + "}"
+
+def formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        x = bisect.bisect_left(self.buckets, value)
+        if x < len(self.counts):
+            self.counts[x] += 1
+        self.count += 1
+        self.sum += value
+
+class Metrics(object):
+    def __init__(self, prefix="", buckets=defaultBuckets):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self.kinds = {} #name -> "counter", "gauge" or "histogram"
+        self.help = {} #name -> description
+        self.values = {} #name -> {label key: number or Histogram}
+        self.functions = {} #name -> function returning the gauge value at render time
+        self.lock = threading.Lock()
+
+    def metric(self, name, kind):
+        if self.kinds.setdefault(name, kind) != kind:
+            raise ValueError(name + " is a " + self.kinds[name])
+        return self.values.setdefault(name, {})
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def increment(self, name, amount=1, **labels):
+        key = labelKey(labels)
+        with self.lock:
+            values = self.metric(name, "counter")
+            values[key] = values.get(key, 0) + amount
+
+    def setGauge(self, name, value, **labels):
+        with self.lock:
+            self.metric(name, "gauge")[labelKey(labels)] = value
+
+    def gaugeFunction(self, name, function): #function() -> value, called on every render
+        with self.lock:
+            self.metric(name, "gauge")
+            self.functions[name] = function
+
+    def observe(self, name, value, **labels):
+        key = labelKey(labels)
+        with self.lock:
+            values = self.metric(name, "histogram")
+            histogram = values.get(key)
+            if histogram is None:
+                histogram = values[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels): #with metrics.timer("stage_seconds", stage="scan"): ...
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def timed(self, name, **labels): #decorator version of timer
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def get(self, name, **labels): #current value; (count, sum) for a timer
+        with self.lock:
+            value = self.values.get(name, {}).get(labelKey(labels))
+            if isinstance(value, Histogram):
+                return value.count, value.sum
+            return value
+
+    def render(self): #Prometheus text exposition format
+        functionValues = {}
+        for name, function in self.functions.items():
+            try:
+                functionValues[name] = function()
+            except Exception:
+                functionValues[name] = None
+        lines = []
+        with self.lock:
+            for name in sorted(self.kinds):
+                fullName = self.prefix + name
+                if name in self.help:
+                    lines.append("# HELP %s %s" % (fullName, self.help[name]))
+                lines.append("# TYPE %s %s" % (fullName, self.kinds[name]))
+                values = self.values[name]
+                if functionValues.get(name) is not None:
+                    values = dict(values)
+                    values[()] = functionValues[name]
+                for key in sorted(values):
+                    value = values[key]
+                    if isinstance(value, Histogram):
+                        cumulative = 0
+                        for bound, count in zip(value.buckets, value.counts):
+                            cumulative += count
+                            lines.append("%s_bucket%s %d" % (fullName, formatLabels(key, [("le", formatValue(float(bound)))]), cumulative))
+                        lines.append("%s_bucket%s %d" % (fullName, formatLabels(key, [("le", "+Inf")]), value.count))
+                        lines.append("%s_sum%s %s" % (fullName, formatLabels(key), formatValue(value.sum)))
+                        lines.append("%s_count%s %d" % (fullName, formatLabels(key), value.count))
+                    else:
+                        lines.append("%s%s %s" % (fullName, formatLabels(key), formatValue(value)))
+        return "\n".join(lines) + "\n"
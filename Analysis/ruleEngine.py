@@ -0,0 +1,139 @@
+##################################################################
+#ruleEngine.py is part of the Smart Compost system
+#Compiles ordered alert rules into lookup tables. A rule is
+#   {"when": {"value": {"above": "tempHigh"}, "trend": {"below": 1}, "ambient": "low"},
+#    "alert": "warning", "message": 5, "priority": 2, "vent": 1, "water": 1, "append": true}
+#Every part of "when" is optional, the first rule that matches wins.
+#Thresholds are numbers or names of limits. Each threshold splits its input
+#into classes (below, at, above), and the first matching rule is worked out
+#once per combination of classes when the rules are loaded, so a lookup is
+#a bisect over a few thresholds and a table access however many rules
+#there are
+#######
+#Questions: @darianbjohnson (Twitter) or darianbjohnson.com
+##################################################################
+
+import bisect
+
+comparisons = {"above":lambda v, x: v > x, "below":lambda v, x: v < x, "atLeast":lambda v, x: v >= x, "atMost":lambda v, x: v <= x}
+inputs = ["value", "trend"] #numeric inputs of a table; "ambient" is "low" or "high"
+ambients = ["low", "high"]
+outcomeKeys = ["message", "priority", "vent", "water"] #None when a rule leaves them alone
+
+class RuleError(ValueError):
+    pass
+
+class Axis(object): #the classes of one input: below the first threshold, at it, between it and the next, ...
+    def __init__(self, points):
+        self.points = sorted(set(points))
+
+    def classify(self, v):
+        x = bisect.bisect_left(self.points, v)
+        if x < len(self.points) and self.points[x] == v:
+            return 2 * x + 1
+        return 2 * x
+
+    def classifyArray(self, values): #classify over a numpy array; NaN is class 0, as None is for classify
+        import numpy as np #only for batches
+        points = np.asarray(self.points, dtype=float)
+        values = np.asarray(values, dtype=float)
+        classes = np.searchsorted(points, values, "left") + np.searchsorted(points, values, "right") #2x, or 2x + 1 at a point
+        return np.where(np.isnan(values), 0, classes)
+
+    def samples(self): #a value in each class, in class order
+        points = self.points
+        if not points:
+            return [0]
+        values = []
+        for x in range(0, len(points)):
+            values.append(points[0] - 1 if x == 0 else (points[x - 1] + points[x]) / 2.0)
+            values.append(points[x])
+        values.append(points[-1] + 1)
+        return values
+
+def isInteger(x): #JSON true/false are not numbers here
+    return isinstance(x, (int, long)) and not isinstance(x, bool)
+
+class RuleTable(object):
+    def __init__(self, name, rules, limits, alerts, messages=()):
+        self.name = name
+        self.rules = [self.resolve(rule, limits, alerts, messages) for rule in rules]
+        self.axes = {}
+        for key in inputs:
+            self.axes[key] = Axis([threshold for rule in self.rules for op, threshold in rule["when"].get(key, [])])
+        self.valueAxis = self.axes["value"]
+        self.trendAxis = self.axes["trend"]
+        self.table = {} #ambient -> [value class][trend class] -> outcome
+        for a in ambients:
+            self.table[a] = [[self.firstMatch(v, t, a) for t in self.trendAxis.samples()] for v in self.valueAxis.samples()]
+        self.indexes = None #numpy version of self.table for lookupArrays, built on first use
+
+    def resolve(self, rule, limits, alerts, messages): #checks a rule and swaps limit names for numbers
+        when = {}
+        for key, condition in rule.get("when", {}).items():
+            if key == "ambient":
+                if condition not in ambients:
+                    raise RuleError("%s: ambient must be one of %s" % (self.name, ", ".join(ambients)))
+                when[key] = condition
+                continue
+            if key not in inputs:
+                raise RuleError("%s: unknown condition %s" % (self.name, key))
+            when[key] = []
+            for op, threshold in condition.items():
+                if op not in comparisons:
+                    raise RuleError("%s: unknown comparison %s" % (self.name, op))
+                if not isinstance(threshold, (int, long, float)):
+                    if threshold not in limits:
+                        raise RuleError("%s: unknown limit %s" % (self.name, threshold))
+                    threshold = limits[threshold]
+                when[key].append((op, threshold))
+        if rule.get("alert") not in alerts:
+            raise RuleError("%s: alert must be one of %s" % (self.name, ", ".join(sorted(alerts))))
+        outcome = dict((key, rule.get(key)) for key in outcomeKeys)
+        if outcome["message"] is not None and not (isInteger(outcome["message"]) and 0 <= outcome["message"] < len(messages)):
+            if not messages:
+                raise RuleError("%s: rules have no messages" % self.name)
+            raise RuleError("%s: message must be a number from 0 to %d" % (self.name, len(messages) - 1))
+        if outcome["priority"] is not None and not isInteger(outcome["priority"]):
+            raise RuleError("%s: priority must be a whole number" % self.name)
+        if outcome["message"] is not None and outcome["priority"] is None:
+            raise RuleError("%s: a rule with a message needs a priority" % self.name)
+        for key in ["vent", "water"]:
+            if outcome[key] is not None and not (isInteger(outcome[key]) and outcome[key] in (0, 1)):
+                raise RuleError("%s: %s must be 0 or 1" % (self.name, key))
+        outcome["alert"] = alerts[rule["alert"]]
+        outcome["append"] = bool(rule.get("append"))
+        return {"when":when, "outcome":outcome}
+
+    def matches(self, rule, v, t, a):
+        when = rule["when"]
+        if "ambient" in when and when["ambient"] != a:
+            return False
+        for key, x in [("value", v), ("trend", t)]:
+            for op, threshold in when.get(key, []):
+                if not comparisons[op](x, threshold):
+                    return False
+        return True
+
+    def firstMatch(self, v, t, a):
+        for rule in self.rules:
+            if self.matches(rule, v, t, a):
+                return rule["outcome"]
+        return None
+
+    def lookup(self, value, trend=0, ambient="high"): #outcome of the first matching rule, or None
+        return self.table[ambient][self.valueAxis.classify(value)][self.trendAxis.classify(trend)]
+
+    def lookupArrays(self, values, trends=0, ambientLow=False): #lookup over numpy arrays: the rule index of each match, len(self.rules) where none matches
+        import numpy as np
+        if self.indexes is None:
+            outcomes = [id(rule["outcome"]) for rule in self.rules]
+            position = lambda outcome: len(self.rules) if outcome is None else outcomes.index(id(outcome))
+            self.indexes = np.array([[[position(outcome) for outcome in row] for row in self.table[a]] for a in ambients])
+        ambient = np.where(np.asarray(ambientLow, dtype=bool), ambients.index("low"), ambients.index("high"))
+        return self.indexes[ambient, self.valueAxis.classifyArray(values), self.trendAxis.classifyArray(trends)]
+
+    def outcomeArrays(self, key): #(value, set) of the outcome key for each rule index from lookupArrays
+        import numpy as np
+        values = [rule["outcome"][key] for rule in self.rules] + [None]
+        return np.array([0 if value is None else value for value in values]), np.array([value is not None for value in values])
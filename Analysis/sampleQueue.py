@@ -0,0 +1,167 @@
+##################################################################
+#sampleQueue.py is part of the Smart Compost system
+#A durable append-only queue on local disk, used between the ingest
+#process (BLE only) and the analyzer process. Records are JSON lines with
+#a CRC, in segment files named after the offset they start at:
+#   <folder>/<name>/00000000000000000000.log
+#An offset is a byte position across the segments. Writers fsync in
+#batches (every fsyncBatch records or fsyncInterval secs); a record torn
+#by a crash fails its CRC and is cut off when the queue is opened again.
+#Readers keep their own offset and commit it wherever suits them - the
+#analyzer stores it in SQLite in the same transaction as the readings
+#######
+#Questions: @darianbjohnson (Twitter) or darianbjohnson.com
+##################################################################
+
+import binascii
+import io
+import json
+import os
+import threading
+import time
+
+segmentSize = 4 * 1024 * 1024 #bytes - a new segment is started after this
+fsyncBatch = 50 #records written before an fsync...
+fsyncInterval = 1.0 #...or secs since the last one
+
+def segmentName(base):
+    return "%020d.log" % base
+
+def listSegments(folder): #sorted base offsets
+    if not os.path.isdir(folder):
+        return []
+    return sorted(int(name[:-4]) for name in os.listdir(folder) if name.endswith(".log") and name[:-4].isdigit())
+
+def encode(record):
+    body = json.dumps(record, sort_keys=True, separators=(",", ":"))
+    return "%08x %s\n" % (binascii.crc32(body) & 0xffffffff, body)
+
+def decode(line): #record, or None if the line is torn or corrupt
+    if not line.endswith("\n") or len(line) < 10:
+        return None
+    body = line[9:-1]
+    try:
+        if int(line[:8], 16) != binascii.crc32(body) & 0xffffffff:
+            return None
+        return json.loads(body)
+    except ValueError:
+        return None
+
+#*************************************************************
+#Writer: one per queue, safe to share between threads
+#*************************************************************
+class QueueWriter(object):
+    def __init__(self, folder):
+        self.folder = folder
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.lastSync = time.time()
+        segments = listSegments(folder)
+        self.base = segments[-1] if segments else 0
+        self.f = io.open(os.path.join(folder, segmentName(self.base)), "a+b")
+        self.size = self.validLength()
+        self.f.truncate(self.size) #cut off a record torn by a crash
+        self.f.seek(0, os.SEEK_END)
+        t = threading.Thread(target=self.syncLoop)
+        t.daemon = True
+        t.start()
+
+    def validLength(self):
+        self.f.seek(0)
+        length = 0
+        for line in self.f:
+            if decode(line) is None:
+                break
+            length += len(line)
+        return length
+
+    def append(self, record): #returns the offset after the record
+        line = encode(record)
+        with self.lock:
+            if self.size >= segmentSize:
+                self.rotate()
+            self.f.write(line)
+            self.f.flush()
+            self.size += len(line)
+            self.unsynced += 1
+            if self.unsynced >= fsyncBatch or time.time() - self.lastSync >= fsyncInterval:
+                self.syncLocked()
+            return self.base + self.size
+
+    def rotate(self):
+        self.syncLocked()
+        self.f.close()
+        self.base += self.size
+        self.size = 0
+        self.f = io.open(os.path.join(self.folder, segmentName(self.base)), "a+b")
+
+    def sync(self):
+        with self.lock:
+            self.syncLocked()
+
+    def syncLocked(self):
+        if self.unsynced:
+            os.fsync(self.f.fileno())
+            self.unsynced = 0
+        self.lastSync = time.time()
+
+    def syncLoop(self): #records written just before a quiet spell are synced too
+        while True:
+            time.sleep(fsyncInterval)
+            with self.lock:
+                if self.unsynced and time.time() - self.lastSync >= fsyncInterval:
+                    self.syncLocked()
+
+#*************************************************************
+#Reader: reads from an offset the caller keeps
+#*************************************************************
+class QueueReader(object):
+    def __init__(self, folder):
+        self.folder = folder
+
+    def read(self, offset, maxRecords): #[(offset after the record, record), ...]
+        records = []
+        segments = listSegments(self.folder)
+        for x, base in enumerate(segments):
+            end = segments[x + 1] if x + 1 < len(segments) else None
+            if end is not None and end <= offset:
+                continue
+            with io.open(os.path.join(self.folder, segmentName(base)), "rb") as f:
+                f.seek(max(0, offset - base))
+                position = max(offset, base)
+                for line in f:
+                    record = decode(line)
+                    if record is None: #not completely written yet
+                        return records
+                    position += len(line)
+                    records.append((position, record))
+                    if len(records) >= maxRecords:
+                        return records
+            offset = position
+        return records
+
+    def discardable(self, offset): #whether discard(offset) would delete a segment
+        segments = listSegments(self.folder)
+        return len(segments) > 1 and segments[1] <= offset
+
+    def discard(self, offset): #deletes segments that end at or before the offset
+        segments = listSegments(self.folder)
+        for x in range(0, len(segments) - 1):
+            if segments[x + 1] <= offset:
+                os.remove(os.path.join(self.folder, segmentName(segments[x])))
+
+def loadOffset(path): #a reader offset kept in a file
+    try:
+        with io.open(path, "rb") as f:
+            return int(f.read().strip() or 0)
+    except IOError:
+        return 0
+
+def saveOffset(path, offset):
+    with io.open(path + ".tmp", "wb") as f:
+        f.write(str(offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + ".tmp", path)
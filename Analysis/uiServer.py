@@ -0,0 +1,274 @@
+##################################################################
+#uiServer.py is part of the Smart Compost system
+#A small HTTP server that runs inside the analysis process. It serves the
+#dashboard files and pushes every new UI payload to the open pages as
+#Server-Sent Events (GET /events), so pages don't have to poll
+#currentReadings.json. One thread and one poll() loop handle every
+#connection, so hundreds of open dashboards cost a socket each
+#######
+#Questions: @darianbjohnson (Twitter) or darianbjohnson.com
+##################################################################
+
+import errno
+import json
+import mimetypes
+import os
+import select
+import socket
+import threading
+import time
+
+keepAliveSecs = 15 #comment line sent to idle subscribers so proxies keep the stream open
+maxBufferedBytes = 256 * 1024 #a subscriber that is still this far behind when the next frame comes is dropped
+acceptPauseSecs = 1 #out of file descriptors: connections wait in the backlog this long before accept is tried again
+maxRequestBytes = 8192
+
+class Client(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = ""
+        self.outbuf = []
+        self.outbytes = 0
+        self.subscriber = False
+        self.closeWhenSent = False
+
+    def send(self, data):
+        self.outbuf.append(data)
+        self.outbytes += len(data)
+
+class UIServer(object):
+    def __init__(self, port, root, host=""):
+        self.port = port
+        self.host = host
+        self.root = os.path.abspath(root)
+        self.routes = {} #path -> function returning (content type, body)
+        self.clients = {} #fd -> Client
+        self.pending = [] #events queued by other threads
+        self.lastEvents = {} #(event name, key) -> last frame, replayed to new subscribers
+        self.lock = threading.Lock()
+        self.thread = None
+        self.listener = None
+        self.wakeRead, self.wakeWrite = os.pipe()
+        self.poller = None
+        self.acceptPausedUntil = None
+
+    def addRoute(self, path, function):
+        self.routes[path] = function
+
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen(128)
+        self.listener.setblocking(0)
+        self.poller = select.poll()
+        self.poller.register(self.listener.fileno(), select.POLLIN)
+        self.poller.register(self.wakeRead, select.POLLIN)
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+        print "Dashboard server listening on port " + str(self.port)
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def subscriberCount(self):
+        return len([c for c in self.clients.values() if c.subscriber])
+
+    #*************************************************************
+    #Called from any thread - queues the event and wakes up the loop
+    #*************************************************************
+    def publish(self, payload, event=None, key=None): #frames of an event with different keys (e.g. one per pile) are all replayed
+        frame = ""
+        if event is not None:
+            frame = "event: " + event + "\n"
+        frame += "data: " + json.dumps(payload, sort_keys=True) + "\n\n"
+        running = self.isRunning()
+        with self.lock:
+            self.lastEvents[(event, key)] = frame
+            if running: #nothing drains pending without the loop; lastEvents replays to later subscribers
+                self.pending.append(frame)
+        if running:
+            os.write(self.wakeWrite, "x")
+
+    #*************************************************************
+    #Event loop
+    #*************************************************************
+    def serve(self):
+        lastKeepAlive = time.time()
+        while True:
+            try:
+                events = self.poller.poll((acceptPauseSecs if self.acceptPausedUntil else keepAliveSecs) * 1000)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, flags in events:
+                try:
+                    self.handleEvent(fd, flags)
+                except Exception as e: #one bad connection mustn't stop the dashboard for everyone
+                    print "Dashboard server error: " + str(e)
+                    if fd in self.clients:
+                        self.close(self.clients[fd])
+            if self.acceptPausedUntil is not None and time.time() >= self.acceptPausedUntil:
+                self.acceptPausedUntil = None
+                self.poller.modify(self.listener.fileno(), select.POLLIN)
+            if time.time() - lastKeepAlive >= keepAliveSecs:
+                lastKeepAlive = time.time()
+                self.broadcast(": keep-alive\n\n")
+
+    def handleEvent(self, fd, flags):
+        if fd == self.listener.fileno():
+            self.accept()
+        elif fd == self.wakeRead:
+            os.read(self.wakeRead, 4096)
+            self.broadcastPending()
+        elif fd in self.clients:
+            client = self.clients[fd]
+            if flags & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                self.close(client)
+                return
+            if flags & select.POLLIN:
+                self.read(client)
+            if fd in self.clients and flags & select.POLLOUT:
+                self.write(client)
+
+    def accept(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if e.args[0] in (errno.ECONNABORTED, errno.EINTR):
+                    continue
+                #e.g. EMFILE: the listener would stay readable, so stop watching it for a while
+                print "Dashboard server can't accept connections: " + str(e)
+                self.acceptPausedUntil = time.time() + acceptPauseSecs
+                self.poller.modify(self.listener.fileno(), 0)
+                return
+            sock.setblocking(0)
+            self.clients[sock.fileno()] = Client(sock)
+            self.poller.register(sock.fileno(), select.POLLIN)
+
+    def read(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ""
+        if not data:
+            self.close(client)
+            return
+        if client.subscriber:
+            return #nothing more is expected on an event stream
+        client.inbuf += data
+        if "\r\n\r\n" in client.inbuf:
+            self.handleRequest(client)
+        elif len(client.inbuf) > maxRequestBytes:
+            self.close(client)
+
+    def write(self, client):
+        while client.outbuf:
+            data = client.outbuf[0]
+            try:
+                sent = client.sock.send(data)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                self.close(client)
+                return
+            client.outbytes -= sent
+            if sent < len(data):
+                client.outbuf[0] = data[sent:]
+                break
+            client.outbuf.pop(0)
+        if not client.outbuf and client.closeWhenSent:
+            self.close(client)
+        else:
+            self.watch(client)
+
+    def watch(self, client):
+        flags = select.POLLIN
+        if client.outbuf:
+            flags |= select.POLLOUT
+        self.poller.modify(client.sock.fileno(), flags)
+
+    def close(self, client):
+        fd = client.sock.fileno()
+        if fd in self.clients:
+            del self.clients[fd]
+            self.poller.unregister(fd)
+        client.sock.close()
+
+    def queue(self, client, data):
+        if client.outbytes > maxBufferedBytes: #the backlog left after the last writes, not counting this frame
+            print "Dropping slow dashboard subscriber"
+            self.close(client)
+            return
+        client.send(data)
+        self.write(client)
+
+    def broadcastPending(self):
+        with self.lock:
+            frames = self.pending
+            self.pending = []
+        for frame in frames:
+            self.broadcast(frame)
+
+    def broadcast(self, frame): #the same string object goes to every subscriber
+        for client in self.clients.values():
+            if client.subscriber:
+                self.queue(client, frame)
+
+    #*************************************************************
+    #Requests
+    #*************************************************************
+    def handleRequest(self, client):
+        requestLine = client.inbuf.split("\r\n", 1)[0].split(" ")
+        client.inbuf = ""
+        if len(requestLine) < 2 or requestLine[0] not in ("GET", "HEAD"):
+            self.respond(client, "405 Method Not Allowed", "text/plain", "Method not allowed")
+            return
+        path = requestLine[1].split("?", 1)[0]
+        if path == "/events":
+            client.subscriber = True
+            headers = "HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: keep-alive\r\nAccess-Control-Allow-Origin: *\r\n\r\n"
+            with self.lock:
+                replay = "".join(self.lastEvents.values())
+            self.queue(client, headers + "retry: 10000\n\n" + replay)
+        elif path in self.routes:
+            try:
+                contentType, body = self.routes[path]()
+            except Exception as e:
+                print "Dashboard route " + path + " failed: " + str(e)
+                self.respond(client, "500 Internal Server Error", "text/plain", "Internal server error")
+                return
+            self.respond(client, "200 OK", contentType, body, requestLine[0] == "HEAD")
+        else:
+            self.serveFile(client, path, requestLine[0] == "HEAD")
+
+    def serveFile(self, client, path, headOnly):
+        if path.endswith("/"):
+            path += "index.html"
+        filePath = os.path.abspath(os.path.join(self.root, path.lstrip("/")))
+        if not filePath.startswith(self.root + os.sep) or not os.path.isfile(filePath):
+            self.respond(client, "404 Not Found", "text/plain", "Not found")
+            return
+        try:
+            with open(filePath, "rb") as f:
+                body = f.read()
+        except IOError as e: #e.g. replaced or removed since isfile
+            print "Serving " + filePath + " failed: " + str(e)
+            self.respond(client, "500 Internal Server Error", "text/plain", "Internal server error")
+            return
+        contentType = mimetypes.guess_type(filePath)[0] or "application/octet-stream"
+        self.respond(client, "200 OK", contentType, body, headOnly)
+
+    def respond(self, client, status, contentType, body, headOnly=False):
+        headers = "HTTP/1.1 " + status + "\r\nContent-Type: " + contentType + "\r\nContent-Length: " + str(len(body)) + "\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n"
+        if headOnly:
+            body = ""
+        client.closeWhenSent = True
+        self.queue(client, headers + body)
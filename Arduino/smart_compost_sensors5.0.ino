@@ -35,6 +35,51 @@ BLECharacteristic methanePPM("0411dc95-895b-4639-b627-c663f6726c3c", BLERead, 5)
 BLECharacteristic waterLevel("0411dc96-895b-4639-b627-c663f6726c3c", BLERead, 2);
 BLEUnsignedCharCharacteristic ventAngle("0411dc97-895b-4639-b627-c663f6726c3c", BLERead | BLEWrite);
 BLEUnsignedCharCharacteristic startPump("0411dc98-895b-4639-b627-c663f6726c3c", BLERead | BLEWrite);
+//all readings in one read, packed as a PackedReading (19 bytes, little endian)
+BLECharacteristic allReadings("0411dc99-895b-4639-b627-c663f6726c3c", BLERead, 20);
+
+//version 1 of the packed format; getReadings.py decodes it with struct "<BIIhhBIB"
+//older firmware sent the ASCII string "tempF,ambientTempF,moisture,methane,waterLevel" instead
+#define PACKED_READING_VERSION 1
+struct PackedReading {
+  uint8_t version;
+  uint32_t sequence;      // counts readings since the sketch started
+  uint32_t sensorTime;    // now(), epoch secs
+  int16_t tempF;          // 1/100 degrees F
+  int16_t ambientTempF;   // 1/100 degrees F
+  uint8_t moisture;       // %
+  uint32_t methane;       // ppm
+  uint8_t waterLevel;
+} __attribute__((packed));
+
+uint32_t readingSequence = 0;
+PackedReading lastReading; //set by readSensors()
+
+/********************************************************************/
+//History settings: a reading is buffered every historyIntervalMS, connected or not.
+//Writing 0 to historyControl sends the unacknowledged readings as historyData
+//notifications, followed by a HistoryEnd; writing a sequence number drops the
+//readings up to it (getReadings.py does that once they are stored)
+BLECharacteristic historyData("0411dc9a-895b-4639-b627-c663f6726c3c", BLENotify, 20);
+BLEUnsignedLongCharacteristic historyControl("0411dc9b-895b-4639-b627-c663f6726c3c", BLEWrite);
+
+struct HistoryEnd {
+  uint8_t version;        // 0, tells it from a PackedReading
+  uint32_t first;         // sequence of the oldest buffered reading (latest + 1 if none)
+  uint32_t latest;        // sequence of the newest buffered reading
+  uint32_t sensorTime;    // now(), so the host can correct for an unset clock
+  uint32_t bootId;        // random per start, sequences restart with it
+} __attribute__((packed));
+
+#define HISTORY_SIZE 96 //24 hours at one reading every 15 mins
+unsigned long historyIntervalMS = 900000; //15 mins
+PackedReading history[HISTORY_SIZE];
+int historyStart = 0; //oldest buffered reading
+int historyCount = 0;
+uint32_t historySequence = 0; //own count, so live reads don't leave gaps
+uint32_t bootId = 0; //set in setup()
+unsigned long lastHistoryMS = 0;
+bool historyStarted = false; //the first reading is buffered right away, then every historyIntervalMS
 
 /********************************************************************/
 
@@ -141,8 +186,15 @@ sensors.begin();
   blePeripheral.addAttribute(waterLevel);
   blePeripheral.addAttribute(ventAngle);
   blePeripheral.addAttribute(startPump);
+  blePeripheral.addAttribute(allReadings);
+  blePeripheral.addAttribute(historyData);
+  blePeripheral.addAttribute(historyControl);
+
 
 
+  //a new bootId tells getReadings.py the history sequence started again
+  randomSeed(analogRead(A5) ^ micros()); //A5 is unconnected
+  bootId = random(1, 0x7FFFFFFF);
 
   //get Sensor Readings
   readSensors() ;
@@ -156,6 +208,8 @@ sensors.begin();
 
 void loop() {
 
+  recordHistory();
+
   BLECentral central = blePeripheral.central();
   if (central) {
     Serial.print("Connected to Edison: ");
@@ -165,6 +219,15 @@ void loop() {
     while (central.connected()) {
 
       readSensors();
+      recordHistory();
+
+      if (historyControl.written()) {
+        if (historyControl.value() == 0) {
+          sendHistory();
+        } else {
+          dropHistory(historyControl.value());
+        }
+      }
 
       if (startPump.written()) {
         if (startPump.value()) {   // any value other than 0
@@ -204,33 +267,90 @@ void readSensors() {
   /********************************************************************/
   
     //Ambient Temperature
-  getAmbientTemperature();
+  float ambientTemperatureF = getAmbientTemperature();
   
   //set DateTime
   getdateTime();
 
   //Temperature
-  getTemperature();
+  float temperatureF = getTemperature();
 
 
 
   //Moisture
-  getMoisture();
+  int moisture = getMoisture();
 
   //Methane
-  getMethanePPM();
+  long methane = getMethanePPM();
 
   //Water Level
-  getWaterLevel();
+  int waterLevelValue = getWaterLevel();
+
+  //All readings
+  PackedReading reading;
+  reading.version = PACKED_READING_VERSION;
+  reading.sequence = ++readingSequence;
+  reading.sensorTime = now();
+  reading.tempF = (int16_t)(temperatureF * 100);
+  reading.ambientTempF = (int16_t)(ambientTemperatureF * 100);
+  reading.moisture = moisture;
+  reading.methane = methane;
+  reading.waterLevel = waterLevelValue;
+  allReadings.setValue((unsigned char *)&reading, sizeof(reading));
+  lastReading = reading;
 
   return;
 }
 
-int getTemperature(void)
+void recordHistory() {
+  if (historyStarted && millis() - lastHistoryMS < historyIntervalMS) {
+    return;
+  }
+  historyStarted = true;
+  lastHistoryMS = millis(); //an ack empties the buffer but keeps the cadence
+  readSensors();
+
+  PackedReading entry = lastReading;
+  entry.sequence = ++historySequence;
+  history[(historyStart + historyCount) % HISTORY_SIZE] = entry;
+  if (historyCount < HISTORY_SIZE) {
+    historyCount++;
+  } else {
+    historyStart = (historyStart + 1) % HISTORY_SIZE; //full, the oldest reading is lost
+  }
+}
+
+void sendHistory() {
+  for (int i = 0; i < historyCount; i++) {
+    PackedReading entry = history[(historyStart + i) % HISTORY_SIZE];
+    historyData.setValue((unsigned char *)&entry, sizeof(entry));
+    delay(20); //let the notification go out before the next one
+  }
+
+  HistoryEnd end;
+  end.version = 0;
+  end.first = historySequence - historyCount + 1;
+  end.latest = historySequence;
+  end.sensorTime = now();
+  end.bootId = bootId;
+  historyData.setValue((unsigned char *)&end, sizeof(end));
+
+  Serial.print("Sent history: ");
+  Serial.println(historyCount);
+}
+
+void dropHistory(uint32_t ack) {
+  while (historyCount > 0 && history[historyStart].sequence <= ack) {
+    historyStart = (historyStart + 1) % HISTORY_SIZE;
+    historyCount--;
+  }
+}
+
+float getTemperature(void)
 {
   sensors.requestTemperatures();
 
-  int sensorValue =  sensors.getTempFByIndex(0);
+  float sensorValue =  sensors.getTempFByIndex(0);
 
   Serial.print("Compost Temperature is: ");
   Serial.println(sensorValue);
@@ -315,17 +435,17 @@ int getWaterLevel() {
   dtostrf(waterLevelValue, 4, 0, charArray);
   waterLevel.setValue(charArray);
 
-  return waterLevel;
+  return waterLevelValue;
 
 }
 
-int getAmbientTemperature() {
+float getAmbientTemperature() {
 
     Serial.print("Humidity:    "); Serial.print(sensorAmbTemp.readHumidity(), 2);
   Serial.print("\tTemperature: "); Serial.println(sensorAmbTemp.readTemperature(), 2);
-  int temperatureC = sensorAmbTemp.readTemperature();
+  float temperatureC = sensorAmbTemp.readTemperature();
 
-  int temperatureF = (temperatureC * 9.0 / 5.0) + 32.0;
+  float temperatureF = (temperatureC * 9.0 / 5.0) + 32.0;
 
   Serial.print("\tTemperature F: "); Serial.println(temperatureF);
   